@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""Cost of call/cc at growing stack depths: capturing a continuation, and
+capturing one then escaping through it right away, the latter with call/ec
+too. All should stay flat as the number of frames below grows to 10k."""
+import gc
+import os
+import sys
+from time import perf_counter
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from tsi.evaluator import Evaluator
+
+COUNT = 2000
+REPEAT = 3
+
+SETUP = '''
+(define (at-depth depth thunk)
+  (if (= depth 0)
+      (thunk)
+      (+ 0 (at-depth (- depth 1) thunk))))
+(define (repeat n proc)
+  (if (= n 0) 0 (begin (proc) (repeat (- n 1) proc))))
+(define (capture) (call/cc (lambda (k) k)))
+(define (escape) (call/cc (lambda (k) (k 1))))
+(define (escape-ec) (call/ec (lambda (k) (k 1))))
+'''
+
+
+def main():
+    evaluator = Evaluator()
+    evaluator.eval(SETUP)
+    print('%6s %14s %14s %14s' % ('depth', 'capture (us)', 'escape (us)', 'call/ec (us)'))
+    for depth in (10, 100, 1000, 10000):
+        times = []
+        for proc in ('capture', 'escape', 'escape-ec', '(lambda () 0)'):
+            exp = '(at-depth %d (lambda () (repeat %d %s)))' % (depth, COUNT, proc)
+            best = None
+            for __ in range(REPEAT):
+                gc.collect()
+                start = perf_counter()
+                evaluator.eval(exp)
+                elapsed = perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            times.append(best)
+        # subtract the time of getting there and looping
+        base = times.pop()
+        print('%6d' % depth + ''.join('%14.2f' % ((t - base) / COUNT * 1e6) for t in times))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""Time of Evaluator.clone against reset followed by loading the library
+again, for libraries of different numbers of definitions. A clone then runs
+a snippet that redefines and sets library variables."""
+import os
+import sys
+from time import perf_counter
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from tsi.evaluator import Evaluator
+
+REPEAT = 20
+SNIPPET = '(define (f0) -1) (set! v1 2) (f1)'
+
+
+def library(n):
+    return ' '.join('(define v%d %d) (define (f%d) (+ v%d (f0)))' % (i, i, i, i)
+                    for i in range(n))
+
+
+def best(fn):
+    times = []
+    for __ in range(REPEAT):
+        start = perf_counter()
+        fn()
+        times.append(perf_counter() - start)
+    return min(times)
+
+
+def main():
+    print('%8s %14s %14s' % ('library', 'reload (ms)', 'clone (ms)'))
+    for n in (10, 100, 1000, 5000):
+        src = library(n)
+        parent = Evaluator()
+        parent.eval(src)
+
+        def reload():
+            parent.reset()
+            parent.eval(src)
+
+        reload_time = best(reload)
+        clone_time = best(lambda: parent.clone().eval(SNIPPET))
+        print('%8d %14.3f %14.3f' % (n, reload_time * 1000, clone_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
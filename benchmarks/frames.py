@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""Evaluator steps (instructions run) per second for a few call-heavy
+programs, and memory allocated for each pending (non-tail) call.
+
+Steps are counted in a separate run whose instruction tuples count their
+indexing. Memory is sampled by a primitive called at the bottom of a deep
+recursion, as blocks (sys.getallocatedblocks) and bytes (tracemalloc)."""
+import gc
+import os
+import sys
+import tracemalloc
+from time import perf_counter
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from tsi import bytecode, SPrimitiveProc
+from tsi.evaluator import Evaluator
+from tsi.expression import theNil
+
+PROGRAMS = (
+    ('fib 18', '(define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))',
+     '(fib 18)'),
+    ('loop 50000', '(define (loop i acc) (if (= i 0) acc (loop (- i 1) (+ acc i))))',
+     '(loop 50000 0)'),
+    ('tak 18 12 6', '(define (tak x y z) (if (not (< y x)) z'
+                   '  (tak (tak (- x 1) y z) (tak (- y 1) z x) (tak (- z 1) x y))))',
+     '(tak 18 12 6)'),
+)
+DEPTH = 5000
+REPEAT = 7
+
+steps = 0
+
+
+class CountedInstructions(tuple):
+    def __getitem__(self, pc):
+        global steps
+        steps += 1
+        return tuple.__getitem__(self, pc)
+
+
+def count(setup, exp):
+    """Return the number of instructions run by exp."""
+    global steps
+    finish = bytecode.Code.finish
+
+    def counted_finish(code):
+        code.instructions = CountedInstructions(code.instructions)
+        return code
+
+    bytecode.Code.finish = counted_finish
+    try:
+        evaluator = Evaluator()
+        evaluator.eval(setup)
+        steps = 0
+        evaluator.eval(exp)
+    finally:
+        bytecode.Code.finish = finish
+    return steps
+
+
+def measure(setup, exp):
+    evaluator = Evaluator()
+    evaluator.eval(setup)
+    start = perf_counter()
+    evaluator.eval(exp)
+    return perf_counter() - start
+
+
+def pending_call_size():
+    """Return blocks and bytes allocated per pending call."""
+    samples = []
+
+    def sample(*__):
+        samples.append((sys.getallocatedblocks(), tracemalloc.get_traced_memory()[0]))
+        return theNil
+
+    evaluator = Evaluator()
+    evaluator._global_env.def_var('sample', SPrimitiveProc(sample, 'sample'))
+    evaluator.eval('(define (deep n) (if (= n 0) (sample) (begin (deep (- n 1)) n)))')
+    evaluator.eval('(deep 1)')  # let everything be compiled and cached
+    gc.collect()
+    tracemalloc.start()
+    try:
+        sample()
+        evaluator.eval('(deep %d)' % DEPTH)
+    finally:
+        tracemalloc.stop()
+    (blocks0, bytes0), (blocks1, bytes1) = samples[-2:]
+    return (blocks1 - blocks0) / DEPTH, (bytes1 - bytes0) / DEPTH
+
+
+def main():
+    print('%-12s %10s %14s' % ('program', 'steps', 'steps/sec'))
+    for title, setup, exp in PROGRAMS:
+        n = count(setup, exp)
+        elapsed = min(measure(setup, exp) for __ in range(REPEAT))
+        print('%-12s %10d %14.0f' % (title, n, n / elapsed))
+    blocks, size = pending_call_size()
+    print('\npending call: %.1f blocks, %.0f bytes' % (blocks, size))
+
+
+if __name__ == '__main__':
+    main()
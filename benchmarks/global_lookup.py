@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""Cost of looking up a global variable (car) from inside closures nested
+DEPTH levels deep. The cached lookup of SGlobalRef should stay flat, while
+looking up by name walks every frame."""
+import os
+import sys
+from timeit import timeit
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from tsi import SFrame
+from tsi.evaluator import Evaluator
+from tsi.expression import analyze, SGlobalRef
+from tsi.parser import parse
+
+NUMBER = 200000
+
+
+def nested_lambda(depth):
+    """(lambda (a1) (lambda (a2) ... car))"""
+    exp = 'car'
+    for i in range(depth, 0, -1):
+        exp = '(lambda (a%d) %s)' % (i, exp)
+    return parse(exp)[0]
+
+
+def innermost(depth, evaluator):
+    """Return the reference to car and the environment it's evaluated in."""
+    env = evaluator._global_env
+    node = analyze(nested_lambda(depth))
+    while not isinstance(node, SGlobalRef):
+        env = SFrame(env, node.frame_names, [evaluator.eval('1')])
+        node = node.body[0]
+    return node, env
+
+
+def by_name(env, name):
+    """Lookup like a name-keyed environment chain would do."""
+    while env.__class__ == SFrame:
+        if name in env.names:
+            return env.values[env.names.index(name)]
+        env = env.enclosing
+    return env.get_var_value(name)
+
+
+def main():
+    evaluator = Evaluator()
+    print('%6s %14s %14s' % ('depth', 'cached (ns)', 'by name (ns)'))
+    for depth in (1, 2, 4, 8, 16, 32, 64):
+        ref, env = innermost(depth, evaluator)
+        cached = timeit(lambda: ref.lookup(env), number=NUMBER)
+        named = timeit(lambda: by_name(env, 'car'), number=NUMBER)
+        print('%6d %14.1f %14.1f' % (depth, cached / NUMBER * 1e9, named / NUMBER * 1e9))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""Time of loading extra/evaluator.scm without the cache of analyzed code,
+with it being written (cold) and with it being used (warm). The loaded
+evaluator runs its driver loop, which reads EOF at once and fails."""
+import os
+import sys
+from time import perf_counter
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from tsi import SchemeError, cache
+from tsi.evaluator import Evaluator
+from tsi.expression import SInputPort, SStringOutputPort
+
+EVALUATOR = os.path.join(os.path.dirname(__file__), '..', 'extra', 'evaluator.scm')
+REPEAT = 20
+
+
+def load(use_cache, purge):
+    if purge:
+        cache.purge(EVALUATOR)
+    evaluator = Evaluator(output=SStringOutputPort(), cache=use_cache)
+    evaluator.input = SInputPort(lambda: '')
+    start = perf_counter()
+    try:
+        evaluator.load_file(EVALUATOR)
+    except SchemeError:
+        pass
+    return perf_counter() - start
+
+
+def main():
+    modes = (('no cache', False, False), ('cold', True, True), ('warm', True, False))
+    for title, use_cache, purge in modes:
+        best = min(load(use_cache, purge) for __ in range(REPEAT))
+        print('%-10s %8.2f ms' % (title, best * 1000))
+
+
+if __name__ == '__main__':
+    main()
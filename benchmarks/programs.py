@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""Run fib/tak/queens with each evaluator configuration and print the time
+taken, for comparing execution modes."""
+import os
+import sys
+from time import perf_counter
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from tsi.evaluator import Evaluator
+
+QUEENS = os.path.join(os.path.dirname(__file__), '..', 'tests', 'queen.scm')
+
+PROGRAMS = (
+    ('fib 18', '(define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))',
+     '(fib 18)'),
+    ('tak 12 8 4', '(define (tak x y z) (if (not (< y x)) z'
+                   '  (tak (tak (- x 1) y z) (tak (- y 1) z x) (tak (- z 1) x y))))',
+     '(tak 12 8 4)'),
+    ('loop 30000', '(define (loop i acc) (if (= i 0) acc (loop (- i 1) (+ acc i))))',
+     '(loop 30000 0)'),
+    ('queens 6', None, '(queens 6)'),
+)
+
+CONFIGS = (
+    ('vm', {}),
+    ('optimize', {'optimize': True}),
+)
+
+
+def main():
+    print('%-12s' % 'program' + ''.join('%12s' % name for name, __ in CONFIGS))
+    for title, setup, exp in PROGRAMS:
+        times = []
+        for __, kwargs in CONFIGS:
+            evaluator = Evaluator(**kwargs)
+            if setup:
+                evaluator.eval(setup)
+            else:
+                evaluator.load_file(QUEENS)
+            start = perf_counter()
+            evaluator.eval(exp)
+            times.append(perf_counter() - start)
+        print('%-12s' % title + ''.join('%11.3fs' % t for t in times))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Tokens per second of parser.parse on multi-megabyte sources, against the
+recursive parse it replaced (kept below as old_parse)."""
+import os
+import re
+import sys
+from collections import deque
+from time import perf_counter
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from tsi.parser import parse, _token
+
+EVALUATOR = os.path.join(os.path.dirname(__file__), '..', 'extra', 'evaluator.scm')
+
+_tokenize = re.compile(r'''\(|\)|"[^"]*"|'|[^\(\)\s"]+''')
+
+
+def old_parse(src):
+    def read_from_tokens():
+        token = tokens.popleft()
+        if token == '(':
+            lv = deque()
+            while tokens[0] != ')':
+                lv.append(read_from_tokens())
+            tokens.popleft()
+            return tuple(lv)
+        elif token == "'":
+            return ('quote', read_from_tokens())
+        else:
+            return token
+
+    src = ''.join(map(lambda l: l.partition(';')[0], src.split('\n')))
+    tokens = deque(_tokenize.findall('(%s)' % src))
+    return read_from_tokens()
+
+
+def records(n):
+    return ''.join('(rec %d "name %d" (a b c) \'q) ; record\n' % (i, i) for i in range(n))
+
+
+def source(size):
+    with open(EVALUATOR, encoding='utf-8') as f:
+        src = f.read()
+    return src * (size // len(src) + 1)
+
+
+def nested(depth):
+    return '(a ' * depth + ')' * depth
+
+
+INPUTS = (
+    ('records', records(100000)),
+    ('evaluator.scm', source(4 << 20)),
+    ('nested 5000', nested(5000) * 200),
+)
+
+
+def tokens_per_sec(fn, src, ntokens):
+    start = perf_counter()
+    try:
+        fn(src)
+    except RecursionError:
+        return None
+    return ntokens / (perf_counter() - start)
+
+
+def main():
+    print('%-14s %8s %10s %14s %14s' % ('input', 'MB', 'tokens', 'old (tok/s)', 'new (tok/s)'))
+    for title, src in INPUTS:
+        ntokens = sum(1 for m in _token.finditer(src) if m.group(1))
+        old, new = (tokens_per_sec(fn, src, ntokens) for fn in (old_parse, parse))
+        print('%-14s %8.1f %10d %14s %14.0f' % (title, len(src) / 1e6, ntokens,
+                                                'RecursionError' if old is None else '%.0f' % old,
+                                                new))
+
+
+if __name__ == '__main__':
+    main()
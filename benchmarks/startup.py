@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""Startup latency: a new process from import tsi through the first eval,
+and evaluators made later in the same process, with and without the global
+environment image (see Evaluator._setup_global_env)."""
+import os
+import subprocess
+import sys
+from time import perf_counter
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from tsi import evaluator as evaluator_module
+from tsi.evaluator import Evaluator
+
+REPEAT = 20
+FIRST_EVAL = '''
+from time import perf_counter
+start = perf_counter()
+import tsi
+from tsi.evaluator import Evaluator
+Evaluator().eval('(abs -1)')
+print(perf_counter() - start)
+'''
+
+
+def process():
+    """Seconds from import tsi through the first eval in a new process."""
+    out = subprocess.check_output([sys.executable, '-c', FIRST_EVAL], cwd=ROOT)
+    return float(out)
+
+
+def evaluator(image):
+    if not image:
+        evaluator_module._images.clear()
+    start = perf_counter()
+    Evaluator().eval('(abs -1)')
+    return perf_counter() - start
+
+
+def main():
+    rows = (('new process', process),
+            ('evaluator without image', lambda: evaluator(False)),
+            ('evaluator with image', lambda: evaluator(True)))
+    for title, fn in rows:
+        best = min(fn() for __ in range(REPEAT))
+        print('%-24s %9.3f ms' % (title, best * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,12 +2,10 @@
 generated by tk canvas) to PNG."""
 import turtle
 import re
-import sys
 import subprocess
 import turtleext
-from io import StringIO
 from tsi.evaluator import Evaluator
-from tsi.expression import theNil
+from tsi.expression import theNil, SStringOutputPort
 
 
 load_ext_pattern = re.compile(r'^\s*\(\s*load-ext\s*"turtleext"\s*\).*')
@@ -36,11 +34,9 @@ def exec_script(script):
         turtle.speed(10)
         turtle.tracer(1000)
 
-    origin_stdout = sys.stdout
-    out = sys.stdout = StringIO()
-    evaluator = Evaluator()
+    out = SStringOutputPort()
+    evaluator = Evaluator(output=out)
     evaluator.eval(script)
-    sys.stdout = origin_stdout
 
     image = None
     if turtle_used:
@@ -48,8 +44,7 @@ def exec_script(script):
         turtle.hideturtle()
         image = postscript2png(turtle.getscreen().getcanvas().postscript())
         turtle.reset()
-    out.seek(0)
-    return out.read(), image
+    return out.getvalue(), image
 
 
 if __name__ == '__main__':
@@ -1,6 +1,17 @@
+import gc
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
 from unittest import TestCase, main
 from tsi.evaluator import Evaluator
-from tsi.parser import parse
+from tsi.parser import parse, Reader
+import tsi
+from tsi import SchemeError, cache
+from tsi.expression import SOutputPort, SStringOutputPort, SSymbol, analyze
 
 evaluator = Evaluator()
 ev = lambda exp: evaluator.eval(exp)  # shortcut
@@ -22,6 +33,24 @@ class TestParser(TestCase):
         self.assertRaises(Exception, parse, '')
         self.assertRaises(Exception, parse, '())')
 
+    def test_comments_and_strings(self):
+        self.assertEqual(parse('(a "b ; c" ; d\n e)'), (('a', '"b ; c"', 'e'),))
+        self.assertEqual(parse('(define x\n1)'), (('define', 'x', '1'),))
+        depth = 100000
+        self.assertEqual(len(parse('(' * depth + ')' * depth)), 1)
+
+    def test_position(self):
+        reader = Reader('a\n (b\n  c) ; (x\n "s\nt"')
+        self.assertEqual([(exp, reader.position()) for exp in reader],
+                         [('a', (1, 1)), (('b', 'c'), (2, 2)), ('"s\nt"', (4, 2))])
+        reader = Reader("(a (b\n  'c) ; (z\n (d))")
+        reader.read()
+        self.assertEqual([reader.locate(path) for path in ((0,), (1, 1), (1, 1, 1), (2, 0))],
+                         [(1, 2), (2, 3), (2, 4), (3, 3)])
+        self.assertRaises(IndexError, reader.locate, (3,))
+        with self.assertRaisesRegex(SchemeError, 'line 2, column 4'):
+            parse('(a\n b))')
+
 
 class TestEvaluator(TestCase):
     def test_lambda(self):
@@ -84,9 +113,360 @@ class TestEvaluator(TestCase):
     def test_let(self):
         self.assertEqual(ev('(let ((x 10) (xx 73)) (+ x xx))'), ev('83'))
 
+    def test_let_forms(self):
+        self.assertEqual(ev('(let ((x 1)) (let ((x 2) (y x)) (list x y)))'), ev('(list 2 1)'))
+        self.assertEqual(ev('(let* ((x 1) (y (+ x 1)) (x (* y 10))) (list x y))'),
+                         ev('(list 20 2)'))
+        self.assertEqual(ev('(letrec ((ev? (lambda (n) (if (= n 0) #t (od? (- n 1)))))'
+                            '         (od? (lambda (n) (if (= n 0) #f (ev? (- n 1))))))'
+                            '  (ev? 100))'), ev('#t'))
+        self.assertEqual(ev('(let loop ((i 0) (acc 0)) (if (= i 4) acc (loop (+ i 1) (+ acc i))))'),
+                         ev('6'))
+        self.assertEqual(ev('(let () (define a 1) (define (f) a) (f))'), ev('1'))
+
+    def test_do(self):
+        self.assertEqual(ev('(do ((i 0 (+ i 1)) (acc nil (cons i acc))) ((= i 3) acc))'),
+                         ev('(list 2 1 0)'))
+        ev('(define x 0)')
+        ev('(do ((i 0 (+ i 1))) ((= i 2)) (set! x (+ x i)))')
+        self.assertEqual(ev('x'), ev('1'))
+        self.assertEqual(ev('(map (lambda (p) (p))'
+                            '     (do ((i 0 (+ i 1)) (ps nil (cons (lambda () i) ps)))'
+                            '         ((= i 3) ps)))'), ev('(list 2 1 0)'),
+                         msg='closures see the binding of their iteration')
+        self.assertEqual(ev('(vector->list (do ((vec (make-vector 5)) (i 0 (+ i 1)))'
+                            '                  ((= i 5) vec)'
+                            '                (vector-set! vec i i)))'), ev('(list 0 1 2 3 4)'),
+                         msg='a var without step keeps its value')
+        self.assertEqual(ev('(do ((i 0 (+ i 1)) (acc 5)) ((= i 3) acc) (set! acc (+ acc 1)))'),
+                         ev('8'))
+
+    def test_when(self):
+        self.assertEqual(ev('(when (= 1 1) 1 2)'), ev('2'))
+        self.assertEqual(ev('(unless (= 1 1) 1 2)'), ev('#f'))
+
+    def test_tail_position(self):
+        try:
+            import resource
+        except ImportError:
+            self.skipTest('resource module unavailable')
+        ev('(define (loop n)'
+           '  (cond ((= n 0) (quote done))'
+           '        (else (let ((m (- n 1)))'
+           '                (begin (when #t (and #t (or #f (loop m)))))))))')
+        # a frame for each iteration would take hundreds of MB
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.assertEqual(ev('(loop 1000000)'), ev('(quote done)'))
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.assertLess(after - before, 50 * 1024)  # KB on Linux
+
+    def test_self_tail_call(self):
+        ev('(define (collect n acc)'
+           '  (if (= n 0) acc (collect (- n 1) (cons (lambda () n) acc))))')
+        self.assertEqual(ev('(map (lambda (p) (p)) (collect 3 nil))'), ev('(list 1 2 3)'),
+                         msg='frame captured by closures')
+        ev('(define (collect-let n acc)'
+           '  (if (= n 0) acc'
+           '      (collect-let (- n 1) (cons (let ((m n)) (lambda () (+ m n))) acc))))')
+        self.assertEqual(ev('(map (lambda (p) (p)) (collect-let 3 nil))'), ev('(list 2 4 6)'),
+                         msg='frame captured by closures in a let')
+        self.assertEqual(ev('(map (lambda (p) (p))'
+                            '     (do ((i 0 (+ i 1)) (ps nil (cons (let ((j i)) (lambda () (list i j)))'
+                            '                                    ps)))'
+                            '         ((= i 3) ps)))'), ev('(quote ((2 2) (1 1) (0 0)))'),
+                         msg='do frame captured by closures in a let')
+        ev('(define (f n)'
+           '  (if (= n 5) (set! f (lambda (n) (quote changed))))'
+           '  (if (= n 0) (quote done) (f (- n 1))))')
+        self.assertEqual(ev('(f 10)'), ev('(quote changed)'))
+        ev('(define k nil)')
+        ev('(define (g n acc)'
+           '  (if (= n 0) acc'
+           '      (g (- n 1) (+ acc (call/cc (lambda (c) (if (= n 2) (set! k c)) n))))))')
+        self.assertEqual(ev('(g 3 0)'), ev('6'))
+        self.assertEqual(ev('(k 100)'), ev('104'), msg='frame captured by continuation')
+
+    def test_lexical_scope(self):
+        ev('(define (adder a) (lambda (b) (lambda (c) (+ a b c))))')
+        self.assertEqual(ev('(((adder 1) 2) 3)'), ev('6'))
+        ev('(define (counter) (define n 0) (lambda () (set! n (+ n 1)) n))')
+        ev('(define cnt (counter))')
+        ev('(cnt)')
+        self.assertEqual(ev('(cnt)'), ev('2'))
+
+    def test_internal_define(self):
+        ev('(define (parity n)'
+           '  (define (ev? n) (if (= n 0) (quote even) (od? (- n 1))))'
+           '  (define (od? n) (if (= n 0) (quote odd) (ev? (- n 1))))'
+           '  (ev? n))')
+        self.assertEqual(ev('(parity 7)'), ev('(quote odd)'))
+        ev('(define (early) (define a b) (define b 1) a)')
+        self.assertRaises(SchemeError, ev, '(early)')
+
+    def test_global_redefinition(self):
+        ev('(define (inc x) (add x 1))')
+        ev('(define add +)')
+        self.assertEqual(ev('(inc 1)'), ev('2'))
+        ev('(define add -)')
+        self.assertEqual(ev('(inc 1)'), ev('0'), msg='cached binding is stale')
+        ev('(set! add *)')
+        self.assertEqual(ev('(inc 1)'), ev('1'))
+
+    def test_simple_application(self):
+        ev('(define lst (list 1 2))')
+        self.assertEqual(ev('(apply + lst)'), ev('3'))
+        ev('(define (ping n) (if (= n 0) (quote done) (pong n)))')
+        ev('(define (pong n) (ping (- n 1)))')
+        self.assertEqual(ev('(ping 50000)'), ev('(quote done)'), msg='tail call')
+        ev('(define (f x) (undefined-var x))')
+        self.assertRaises(SchemeError, ev, '(f 1)')
+
     def test_prim_apply(self):
         self.assertEqual(ev('(apply + (list 1 2))'), ev('3'))
 
+    def test_list_procedures(self):
+        self.assertEqual(ev('(list-ref (list 1 2 3) 2)'), ev('3'))
+        self.assertEqual(ev('(append (list 1) (list 2 3) (list 4))'), ev('(list 1 2 3 4)'))
+        self.assertEqual(ev('(assq (quote b) (quote ((a 1) (b 2))))'), ev('(list (quote b) 2)'))
+        self.assertEqual(ev('(caddr (list 1 2 3))'), ev('3'))
+        ev('(define (iota n acc) (if (= n 0) acc (iota (- n 1) (cons n acc))))')
+        ev('(define lst (iota 100000 nil))')
+        self.assertEqual(ev('(length (reverse lst))'), ev('100000'))
+        self.assertEqual(ev('(fold-left + 0 (map (lambda (x) (* x 2)) lst))'), ev('10000100000'))
+        self.assertRaises(SchemeError, ev, '(length (cons 1 2))')
+
+    def test_equivalence(self):
+        self.assertEqual(ev('(eq? (quote a) (quote a))'), ev('#t'))
+        self.assertEqual(ev('(eq? (list 1) (list 1))'), ev('#f'))
+        self.assertEqual(ev('(eqv? 2 2)'), ev('#t'))
+        self.assertEqual(ev('(eqv? 2 2.0)'), ev('#f'))
+        self.assertEqual(ev('(equal? (list 1 (list "a" (quote b))) (list 1 (list "a" (quote b))))'),
+                         ev('#t'))
+        self.assertEqual(ev('(equal? (list 1 2) (list 1 3))'), ev('#f'))
+        ev('(define a (list 1 2))')
+        ev('(define b (list 1 2))')
+        ev('(set-cdr! (cdr a) a)')
+        ev('(set-cdr! (cdr b) b)')
+        self.assertEqual(ev('(equal? a b)'), ev('#t'), msg='cyclic lists')
+        ev('(define lst (do ((i 0 (+ i 1)) (l nil (cons i l))) ((= i 30000) l)))')
+        self.assertEqual(ev('(equal? lst (reverse (reverse lst)))'), ev('#t'))
+
+    def test_symbols(self):
+        self.assertEqual(ev('(eq? (read (open-input-string "sym")) (quote sym))'), ev('#t'))
+        ev('(read (open-input-string "(never-kept-symbol)"))')
+        gc.collect()
+        self.assertNotIn('never-kept-symbol', SSymbol._table)
+        symbols = []
+        threads = [threading.Thread(target=lambda: symbols.extend(
+            SSymbol('threaded-%d' % i) for i in range(2000))) for __ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(map(id, symbols))), 2000, msg='one symbol for each name')
+
+    def test_vector(self):
+        ev('(define v (make-vector 3 0))')
+        ev('(vector-set! v 1 (list 1 2))')
+        self.assertEqual(ev('(vector-ref v 1)'), ev('(list 1 2)'))
+        self.assertEqual(str(ev('v')), '#(0 (1 2) 0)')
+        self.assertEqual(ev('(vector->list (list->vector (list 1 2)))'), ev('(list 1 2)'))
+        self.assertEqual(ev('(equal? (vector 1 (vector 2)) (vector 1 (vector 2)))'), ev('#t'))
+        ev('(vector-set! v 0 v)')
+        self.assertEqual(str(ev('v')), '#0=#(#0# (1 2) 0)')
+        self.assertRaises(SchemeError, ev, '(vector-ref v 3)')
+
+    def test_num_vector(self):
+        ev('(define a (f64vector 1 2 3))')
+        self.assertEqual(str(ev('a')), '#f64(1.0 2.0 3.0)')
+        self.assertEqual(ev('(f64vector-dot a a)'), ev('14.0'))
+        self.assertEqual(ev('(f64vector-sum (f64vector-map * a a))'), ev('14.0'))
+        self.assertEqual(ev('(f64vector->list (f64vector-map (lambda (x) (- x)) a))'),
+                         ev('(list -1.0 -2.0 -3.0)'))
+        self.assertEqual(ev('(s64vector-sum (make-s64vector 3 2))'), ev('6'))
+        self.assertRaises(SchemeError, ev, '(s64vector 1.5)')
+
+    def test_hash_table(self):
+        ev('(define t (make-hash-table))')
+        ev('(hash-table-set! t (quote a) 1)')
+        ev('(hash-table-set! t (list 1 "b") 2)')
+        ev('(hash-table-set! t 1.0 3)')
+        self.assertEqual(ev('(hash-table-ref t (quote a))'), ev('1'))
+        self.assertEqual(ev('(hash-table-ref t (list 1 "b"))'), ev('2'), msg='equal? keys')
+        self.assertEqual(ev('(hash-table-ref/default t 1 0)'), ev('0'))
+        self.assertEqual(ev('(hash-table-ref t 2 (lambda () (quote none)))'), ev('(quote none)'))
+        ev('(hash-table-update! t (quote a) (lambda (x) (+ x 10)))')
+        ev('(hash-table-update!/default t (quote b) (lambda (x) (+ x 1)) 0)')
+        self.assertEqual(ev('(list (hash-table-ref t (quote a)) (hash-table-ref t (quote b)))'),
+                         ev('(list 11 1)'))
+        ev('(hash-table-delete! t 1.0)')
+        self.assertEqual(ev('(hash-table-count t)'), ev('3'))
+        ev('(define sum 0)')
+        ev('(hash-table-walk t (lambda (k v) (set! sum (+ sum v))))')
+        self.assertEqual(ev('sum'), ev('14'))
+        ev('(define q (make-hash-table eq?))')
+        ev('(hash-table-set! q (list 1) 1)')
+        self.assertEqual(ev('(hash-table-keys q)'), ev('(list (list 1))'))
+        self.assertEqual(ev('(hash-table-ref/default q (list 1) #f)'), ev('#f'))
+        self.assertRaises(SchemeError, ev, '(hash-table-ref q 1)')
+        self.assertRaisesRegex(SchemeError, 'Expected eq', ev, '(make-hash-table 5)')
+
+    def test_output_port(self):
+        ev('(define s (open-output-string))')
+        ev('(display "a" s) (newline s) (display (list 1 "b") s)')
+        self.assertEqual(ev('(get-output-string s)'), 'a\n(1 b)')
+        self.assertRaises(SchemeError, ev, '(display 1 2)')
+        out = SStringOutputPort()
+        Evaluator(output=out).eval('(display "x") (print 1 2) (newline)')
+        self.assertEqual(out.getvalue(), 'x1 2\n\n')
+        # flushed when the buffer is full, or evaluation returns
+        target = SStringOutputPort()
+        port = SOutputPort(target, buffer_size=4)
+        port.write('ab')
+        self.assertEqual(target.getvalue(), '')
+        port.write('cd')
+        self.assertEqual(target.getvalue(), 'abcd')
+        Evaluator(output=port).eval('(display "e")')
+        self.assertEqual(target.getvalue(), 'abcde')
+
+    def test_input_port(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.scm', delete=False) as f:
+            f.write('; data\n(a (b "c d")) x\nline two\n')
+        self.addCleanup(os.remove, f.name)
+        ev('(define p (open-input-file "%s"))' % f.name)
+        self.assertEqual(ev('(read p)'), ev('(quote (a (b "c d")))'))
+        self.assertEqual(ev('(read p)'), ev('(quote x)'))
+        self.assertEqual(ev('(read-char p)'), '\n')
+        self.assertEqual(ev('(list (peek-char p) (read-line p))'), ev('(list "l" "line two")'))
+        self.assertEqual(ev('(eof-object? (read p))'), ev('#t'))
+        ev('(close-port p)')
+        self.assertRaises(SchemeError, ev, '(read-char p)')
+        ev('(define (count p n) (if (eof-object? (read p)) n (count p (+ n 1))))')
+        self.assertEqual(ev('(call-with-input-file "%s" (lambda (p) (count p 0)))' % f.name),
+                         ev('4'))
+        self.assertEqual(ev('(read (open-input-string "(1 2)"))'), ev('(list 1 2)'))
+        self.assertRaises(SchemeError, ev, '(read (open-input-string "(1 2"))')
+        ev('(define (depth x n) (if (pair? x) (depth (car x) (+ n 1)) n))')
+        nested = '(' * 5000 + 'x' + ')' * 5000
+        self.assertEqual(ev('(depth (read (open-input-string "%s")) 0)' % nested), ev('5000'))
+        self.assertEqual(ev("(depth '%s 0)" % nested), ev('5000'))
+
+    def test_load(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.scm', delete=False) as f:
+            f.write('(define loaded 1)\n(set! loaded (+ loaded 1))\n(oops\n')
+        self.addCleanup(os.remove, f.name)
+        self.addCleanup(cache.purge, f.name)
+        # expressions are evaluated as they are read
+        self.assertRaises(SchemeError, evaluator.load_file, f.name)
+        self.assertEqual(ev('loaded'), ev('2'))
+        ev('(define loaded 0)')
+        self.assertRaises(SchemeError, ev, '(define (f) (load "%s")) (f)' % f.name)
+        self.assertEqual(ev('loaded'), ev('2'))
+        with open(f.name, 'w') as source:
+            source.write('"a top level string"\n(define loaded 3)\n')
+        evaluator.load_file(f.name)
+        ev('(load "%s")' % f.name)
+        self.assertEqual(ev('loaded'), ev('3'))
+
+    def test_load_cache(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'cached.scm')
+        with open(path, 'w') as f:
+            f.write('(define-record-type point (make-point x y) point? (x point-x) (y point-y))\n'
+                    '(define (f n) (let loop ((i 0) (acc (quote ()))) (if (= i n) acc '
+                    '(loop (+ i 1) (cons (list i "s" #t) acc)))))\n'
+                    '(define (g) (define a 1) (do ((i 0 (+ i 1))) ((= i 3) a) (set! a (* a 2))))\n'
+                    '(list (f 2) (g) (point-x (make-point 5 6)) (eq? (quote s) (quote s)))\n')
+        cold = Evaluator().load_file(path)
+        self.assertTrue(os.path.exists(cache.cache_path(path)))
+        warm = Evaluator().load_file(path)
+        self.assertEqual(str(cold), str(warm))
+        self.assertEqual(warm, ev('(list (list (list 1 "s" #t) (list 0 "s" #t)) 8 5 #t)'))
+        # only the header is read from a cache of another source
+        sentinel = os.path.join(directory, 'unpickled')
+
+        class Opener:
+            def __reduce__(self):
+                return open, (sentinel, 'w')
+        with open(cache.cache_path(path), 'wb') as f:
+            pickle.dump(Opener(), f)
+        self.assertEqual(Evaluator().load_file(path), warm)
+        self.assertFalse(os.path.exists(sentinel))
+        # the source is hashed once its mtime changes, and is the same
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        with open(cache.cache_path(path), 'ab') as f:
+            f.write(pickle.dumps(analyze(parse('(quote from-cache)')[0])))
+        self.assertEqual(Evaluator().load_file(path), ev('(quote from-cache)'))
+        cache.purge(path)
+        Evaluator(cache=False).load_file(path)
+        self.assertFalse(os.path.exists(cache.cache_path(path)))
+        # threads writing the same cache at once
+        errors = []
+
+        def load():
+            try:
+                Evaluator().load_file(path)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=load) for __ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(os.listdir(directory)), ['cached.scm', 'cached.scmc'])
+        # turned off from the command line, or by the environment
+        cache.purge(path)
+        subprocess.check_call([sys.executable, '-c', 'import tsi; tsi.main_entry()',
+                               '--no-cache', path], cwd=os.path.dirname(os.path.dirname(
+                                   os.path.abspath(tsi.__file__))), stdout=subprocess.DEVNULL)
+        os.environ['TSI_NO_CACHE'] = '1'
+        self.addCleanup(os.environ.pop, 'TSI_NO_CACHE')
+        Evaluator().load_file(path)
+        self.assertFalse(os.path.exists(cache.cache_path(path)))
+
+    def test_record_type(self):
+        ev('(define-record-type <point> (make-point x y) point? '
+           '(x point-x set-point-x!) (y point-y) (label point-label set-point-label!))')
+        ev('(define p (make-point 1 2))')
+        ev('(set-point-x! p 10)')
+        self.assertEqual(ev('(list (point-x p) (point-y p) (point? p) (point? (list 1 2)))'),
+                         ev('(list 10 2 #t #f)'))
+        self.assertEqual(str(ev('p')), '#<point x: 10 y: 2 label: ()>')
+        self.assertRaises(SchemeError, ev, '(point-x (list 1 2))')
+        self.assertRaises(SchemeError, ev, '(make-point 1)')
+        self.assertRaises(SchemeError, ev, '(define-record-type r (make-r z) r? (x r-x))')
+        # internal definition
+        ev('(define (leaf v) (define-record-type leaf (make-leaf v) leaf? (v leaf-v)) '
+           '(leaf-v (make-leaf v)))')
+        self.assertEqual(ev('(leaf 5)'), ev('5'))
+
+    def test_write(self):
+        self.assertEqual(str(ev('(quote (1 (2 3) () . 4))')), '(1 (2 3) () . 4)')
+        ev('(define lst (do ((i 0 (+ i 1)) (l nil (cons i l))) ((= i 30000) l)))')
+        self.assertEqual(len(str(ev('lst'))), 168891)
+        self.assertEqual(ev('(length (apply list lst))'), ev('30000'))
+        ev('(define deep (do ((i 0 (+ i 1)) (l nil (list l))) ((= i 30000) l)))')
+        self.assertEqual(len(str(ev('deep'))), 60002)
+        ev('(define c (list 1 2 3))')
+        ev('(set-cdr! (cddr c) c)')
+        self.assertEqual(str(ev('(list c c)')), '(#0=(1 2 3 . #0#) #0#)')
+        ev('(set-car! c c)')
+        self.assertEqual(str(ev('c')), '#0=(#0# 2 3 . #0#)')
+
+    def test_higher_order_procedures(self):
+        self.assertEqual(ev('(map + (list 1 2) (list 10 20))'), ev('(list 11 22)'))
+        self.assertEqual(ev('(filter (lambda (x) (> x 1)) (list 1 2 3))'), ev('(list 2 3)'))
+        self.assertEqual(ev('(fold-right cons nil (list 1 2))'), ev('(list 1 2)'))
+        ev('(define k nil)')
+        ev('(define r (map (lambda (x) (call/cc (lambda (c) (if (= x 2) (set! k c)) x)))'
+           '              (list 1 2 3)))')
+        self.assertEqual(ev('r'), ev('(list 1 2 3)'))
+        ev('(if (= (cadr r) 2) (k 20))')
+        self.assertEqual(ev('r'), ev('(list 1 20 3)'), msg='callback resumed twice')
+
     def test_continuation(self):
         self.assertEqual(ev('(call/cc (lambda (cont) (cont 1)))'), ev('1'))
 
@@ -94,6 +474,95 @@ class TestEvaluator(TestCase):
         self.assertEqual(ev('(a)'), ev('1'),
                          msg='May cause strange problem with env_stack')
 
+    def test_continuation_reentry(self):
+        ev('(define saved nil)')
+        ev('(define (g) (call/cc (lambda (k) (set! saved k) 1)))')
+        ev('(define (h) (+ 100 (+ 10 (g))))')
+        ev('(define r (h))')
+        self.assertEqual(ev('r'), ev('111'))
+        ev('(saved 5)')
+        self.assertEqual(ev('r'), ev('115'))
+        ev('(saved 7)')
+        self.assertEqual(ev('r'), ev('117'), msg='frames resumed twice')
+
+    def test_escape_continuation(self):
+        ev('(define (find pred lst)'
+           '  (call/ec (lambda (return)'
+           '    (for-each (lambda (x) (if (pred x) (return x))) lst)'
+           '    #f)))')
+        self.assertEqual(ev('(find (lambda (x) (> x 2)) (list 1 2 3 4))'), ev('3'))
+        self.assertEqual(ev('(+ 1 (call/ec (lambda (k) 1)))'), ev('2'))
+        ev('(define saved nil)')
+        ev('(call/ec (lambda (outer) (call/ec (lambda (inner) (set! saved inner) (outer 1)))))')
+        self.assertRaises(SchemeError, ev, '(saved 2)')
+
+
+class TestStartup(TestCase):
+    def test_copied_environment(self):
+        first, second = Evaluator(), Evaluator()
+        first.eval('(set! car cdr)')
+        first.eval('(define (< a b) #f)')
+        self.assertEqual(first.eval('(car (list 1 2))'), second.eval('(list 2)'))
+        self.assertEqual(second.eval('(car (list 1 2))'), second.eval('1'))
+        # stdlib procedures refer to the evaluator's own variables
+        self.assertEqual(first.eval('(abs -1)'), first.eval('-1'))
+        self.assertEqual(second.eval('(abs -1)'), second.eval('1'))
+        first.reset()
+        self.assertEqual(first.eval('(car (list 1 2))'), first.eval('1'))
+
+    def test_clone(self):
+        parent = Evaluator()
+        parent.eval('(define n 0) (define (inc!) (set! n (+ n 1)) n)'
+                    '(define inc-later! (let ((step 1)) (lambda () (set! n (+ n step)) n)))')
+        child = parent.clone()
+        self.assertEqual(child.eval('(inc!)'), child.eval('1'))
+        self.assertEqual(child.eval('(inc-later!)'), child.eval('2'))
+        child.eval('(define m 1) (set! car cdr)')
+        self.assertEqual(parent.eval('n'), parent.eval('0'))
+        self.assertRaises(SchemeError, parent.eval, 'm')
+        self.assertEqual(parent.eval('(car (list 1 2))'), parent.eval('1'))
+        # the parent is isolated from clones, and from its own later changes
+        grandchild = child.clone()
+        parent.eval('(inc!)')
+        child.eval('(set! n 10)')
+        self.assertEqual(parent.eval('n'), parent.eval('1'))
+        self.assertEqual(grandchild.eval('(inc!)'), grandchild.eval('3'))
+        self.assertEqual(grandchild.eval('(car (list 1 2))'), grandchild.eval('(list 2)'))
+        self.assertEqual(child.eval('n'), child.eval('10'))
+        # objects and variables of closures made before cloning are shared
+        parent.eval('(define counter (let ((n 0)) (lambda () (set! n (+ n 1)) n)))'
+                    '(define v (vector 0))')
+        child = parent.clone()
+        child.eval('(counter) (counter) (vector-set! v 0 1)')
+        self.assertEqual(parent.eval('(counter)'), parent.eval('3'))
+        self.assertEqual(parent.eval('(vector-ref v 0)'), parent.eval('1'))
+        child.eval('(set! counter car)')
+        self.assertEqual(parent.eval('(counter)'), parent.eval('4'))
+
+    def test_threads(self):
+        library = '(define n 0) (define (inc!) (set! n (+ n (abs -1))) n)'
+        parent = Evaluator()
+        parent.eval(library)
+        evaluators = [Evaluator() for __ in range(4)] + [parent.clone() for __ in range(4)]
+        for i, evaluator in enumerate(evaluators[:4]):
+            evaluator.eval(library)
+        results = {}
+
+        def run(i, evaluator):
+            evaluator.eval('(define m %d)' % i)
+            results[i] = str(evaluator.eval('(do ((i 0 (+ i 1))) ((= i 3000) (list n m))'
+                                            '  (inc!) (set! m (+ m 0)))'))
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-5)
+        self.addCleanup(sys.setswitchinterval, interval)
+        threads = [threading.Thread(target=run, args=i) for i in enumerate(evaluators)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, {i: '(3000 %d)' % i for i in range(len(evaluators))})
+        self.assertEqual(parent.eval('n'), parent.eval('0'))
+
 
 class TestPrograms(TestCase):
     def setUp(self):
@@ -115,5 +584,31 @@ class TestPrograms(TestCase):
                          ev('(quote ((3 1 4 2) (2 4 1 3)))'))
 
 
+class TestOptimizer(TestCase):
+    def setUp(self):
+        self.evaluator = Evaluator(optimize=True)
+        self.ev = self.evaluator.eval
+
+    def test_folding(self):
+        removed = self.evaluator.nodes_removed
+        self.assertEqual(self.ev('(* 2 (+ 1 2))'), self.ev('6'))
+        self.assertGreater(self.evaluator.nodes_removed, removed)
+        self.assertEqual(self.ev('(list 1 (+ 1 1))'), self.ev('(quote (1 2))'))
+        self.ev('(define (f) (/ 1 0))')
+        self.assertRaises(SchemeError, self.ev, '(f)')
+
+    def test_dead_branch(self):
+        self.assertEqual(self.ev('(if #t 1 2)'), self.ev('1'))
+        self.assertEqual(self.ev('(cond ((= 1 2) 1) (else 2))'), self.ev('2'))
+
+    def test_redefinition(self):
+        self.ev('(define (f) (if (> 1 2) (quote a) (+ 1 2)))')
+        self.assertEqual(self.ev('(f)'), self.ev('3'))
+        self.ev('(define (+ a b) (* a b))')
+        self.assertEqual(self.ev('(f)'), self.ev('2'))
+        self.ev('(set! > <)')
+        self.assertEqual(self.ev('(f)'), self.ev('(quote a)'))
+
+
 if __name__ == '__main__':
     main()
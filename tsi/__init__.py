@@ -1,32 +1,68 @@
+from itertools import count
+
 __version__ = '0.5'
 
 
 class SObject:
     """Everything in the Scheme world is SObject. SObject know its text
     representation either by override __str__ or using Python's."""
+    __slots__ = ()  # so subclasses declaring slots have no __dict__
 
 
 class SExp(SObject):
     """The base class of all expressions. Analyzing is done in constructor,
-    and evaluation is done in __call__ method. SExp represents an AST."""
-    def __call__(self, env, evaluator, req=None):
-        """Evaluate this expression in the given environment and return result.
-        If it's necessary to evaluate other expressions, an EvalRequest() will
-        be returned. After eval is done, it will call this method the result
-        (by passing "req" argument)."""
+    and compile method turns the expression into bytecode (see bytecode.py)
+    which is run by the evaluator. SExp represents an AST."""
+    # whether it's compiled into one instruction that pushes the value
+    # without side effect (constants and variables), see instruction
+    simple = False
+
+    def compile(self, code, tail=False):
+        """Append instructions of this expression to code. They leave the
+        value on the stack, or return it if the expression is in tail
+        position."""
+        raise NotImplementedError
+
+    def instruction(self):
+        """The (op, arg) a simple expression is compiled into."""
         raise NotImplementedError
 
+    # optimization, used by Evaluator(optimize=True), see expression.Optimizer
+
+    def optimize(self, optimizer):
+        """Return an equivalent expression that is cheaper to evaluate.
+        Children are replaced by their optimized ones in place."""
+        return self
+
+    def constant(self):
+        """Return the value if it's known at analyze time, else None."""
+        return None
+
+    def nodes(self):
+        """Number of expressions in this tree."""
+        n = 1
+        for value in vars(self).values():
+            for i in value if isinstance(value, tuple) else (value,):
+                if isinstance(i, SExp):
+                    n += i.nodes()
+        return n
+
 
 class SProc(SObject):
     """The base class of all procedures."""
+    pure = False  # may be applied at analyze time, see expression.Optimizer
+
     def apply(self, operands, env, evaluator):
+        """Return the result, or a TailCall to let the evaluator make a call
+        in place of this one."""
         raise NotImplementedError
 
 
 class SPrimitiveProc(SProc):
-    def __init__(self, implement, name=None, err_msg_name=True):
+    def __init__(self, implement, name=None, err_msg_name=True, pure=False):
         self._imp = implement
         self.name = name
+        self.pure = pure  # no side effect, and never returns TailCall
         if not err_msg_name:  # don't add procedure name after error message
             self.apply = self.raw_apply
 
@@ -40,6 +76,8 @@ class SPrimitiveProc(SProc):
             if not e.by:
                 e.by = self.name
             raise
+        except ContinuationInvoked:
+            raise
         except Exception as e:
             raise SchemeError(str(e), self.name)
 
@@ -48,11 +86,15 @@ class SPrimitiveProc(SProc):
 
 
 class SCompoundProc(SProc):
-    def __init__(self, parameters, body, env):
+    def __init__(self, parameters, code, env, frame_names=None):
         self.parameters = parameters
-        self.body = body  # body should already be analyzed
+        self.nparams = len(parameters)
+        self.code = code  # compiled body, instance of bytecode.Code
         self.env = env
         self.name = None  # assigned once by define form
+        # slots of the frame: parameters followed by internal definitions
+        self.frame_names = frame_names or tuple(parameters)
+        self.padding = (unassigned,) * (len(self.frame_names) - self.nparams)
 
     def __str__(self):
         name = self.name + ' ' if self.name else ''
@@ -60,18 +102,67 @@ class SCompoundProc(SProc):
         return '<compound-procedure %s%s>' % (name, para)
 
     def apply(self, operands, *__):
-        # because of static scope, env argument is ignored
-        if len(self.parameters) != len(operands):
-            raise SchemeError('Wrong number of args (%s)' % str(self), 'APPLY')
-        new_env = self.env.make_extend(zip(self.parameters, operands))
-        # eliminate all tail calls, including tail recursion
-        return EvalRequest(self.body, new_env, as_value=True)
+        # the evaluator applies compound procedures itself, so the body
+        # is evaluated in place of the caller (tail call)
+        return TailCall(self, operands)
+
+
+class TailCall:
+    """Returned by SProc.apply (e.g. by primitive apply) to let the evaluator
+    apply proc to operands, whose result is the result of the original
+    call. If then (a procedure) is given, it's applied to the result in
+    turn, so primitives can call back compound procedures (e.g. map): then
+    returns the result of the original call, or another TailCall."""
+    __slots__ = ('proc', 'operands', 'then')
+
+    def __init__(self, proc, operands, then=None):
+        self.proc = proc
+        self.operands = operands
+        self.then = then
+
+
+class _Unassigned:
+    def __reduce__(self):
+        return 'unassigned'  # stays unique when unpickled
+
+
+# value of a slot whose internal definition hasn't been evaluated yet
+unassigned = _Unassigned()
+
+
+class Cell:
+    """Binding of a variable in SEnvironment. Redefining or setting a
+    variable replaces the value of its cell, so a cell obtained once stays
+    valid until a new variable is added somewhere (see SEnvironment.version)."""
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
 
 
 class SEnvironment:
+    """Dict-backed environment, used for the global environment (and others
+    made by Python code). Procedure calls use SFrame instead."""
+    __slots__ = ('enclosing', 'vars', 'top', 'layers')
+
+    # changed whenever a variable is added to any SEnvironment, which may
+    # shadow a variable cached by lookups through its enclosing. Every value
+    # is new (taken from _versions), so it works with evaluators in threads
+    version = 0
+    _versions = count(1)
+
     def __init__(self, enclosing=None, vars_=None):
         self.enclosing = enclosing
-        self.vars = vars_ or {}
+        self.vars = {}
+        # the nearest dict-backed environment, where free variables of
+        # analyzed code are looked up
+        self.top = self
+        # frozen dicts of cells under vars, innermost first. Their cells are
+        # never changed, setting one of their variables puts a new cell in
+        # vars (copy-on-write), see Evaluator.clone
+        self.layers = ()
+        if vars_:
+            self.extend(vars_.items())
 
     def __repr__(self):
         return 'SEnv(%s)' % 'global' if self.enclosing is None else ''
@@ -83,19 +174,28 @@ class SEnvironment:
 
     def extend(self, var_val_pairs):
         """Extend this environment."""
-        self.vars.update(dict(var_val_pairs))
+        for var, value in var_val_pairs:
+            self.def_var(var, value)
+
+    def get_cell(self, var):
+        env = self
+        while var not in env.vars:
+            for layer in env.layers:
+                if var in layer:
+                    return layer[var]
+            env = env.enclosing
+            if env is None:
+                raise SchemeError('Unbound variable (%s)' % var)
+        return env.vars[var]
 
     def get_var_value(self, var):
-        if var in self.vars:
-            return self.vars[var]
-        elif self.enclosing is None:
-            raise SchemeError('Unbound variable (%s)' % var)
-        else:
-            return self.enclosing.get_var_value(var)
+        return self.get_cell(var).value
 
     def set_var_value(self, var, value):
         if var in self.vars:
-            self.vars[var] = value
+            self.vars[var].value = value
+        elif any(var in layer for layer in self.layers):
+            self.def_var(var, value)
         elif self.enclosing is None:
             raise SchemeError('Setting unbound variable (%s)' % var)
         else:
@@ -103,29 +203,31 @@ class SEnvironment:
 
     def def_var(self, var, value):
         """Define a variable (or set if exists) in *this* environment."""
-        self.vars[var] = value
+        if var in self.vars:
+            self.vars[var].value = value
+        else:
+            self.vars[var] = Cell(value)
+            SEnvironment.version = next(SEnvironment._versions)
 
 
-class EvalRequest:
-    """Returning instance of this class (in SExp.__call__) to let the
-    eval evaluate some expressions. The eval will send this instance back
-    after evaluation is done. It's also called "stack frame"."""
-    def __init__(self, exp, env, as_value=False, **kwargs):
-        self.seq = [exp] if isinstance(exp, SExp) else list(exp)  # sequence of SExp to be evaluated
-        self.env = env  # eval under this environment
-        self.idx = -1  # index of last evaluated exp
-        self.caller = None  # the SExp which made this request, set by _eval_iterator
-        self.as_value = as_value  # whether last exp of seq should be the caller's value
-        # control flags set by caller, must be immutable
-        for k, v in kwargs.items():
-            setattr(self, k, v)
+class SFrame:
+    """Environment made by applying a compound procedure. Its variables live
+    in a list and are addressed by (depth, slot) computed at analyze time,
+    names are kept for debugging."""
+    __slots__ = ('enclosing', 'names', 'values', 'top', 'epoch')
 
-    def get(self, i=0):
-        """Get evaluated expressions."""
-        return self.seq[i]
+    def __init__(self, enclosing, names, values, epoch=-1):
+        self.enclosing = enclosing
+        self.names = names
+        self.values = values
+        self.top = enclosing.top
+        # number of continuations captured when made, or -1 once a closure
+        # refers to it. If no continuation has been captured since, nothing
+        # but the running procedure uses it, so a self tail call can reuse it
+        self.epoch = epoch
 
-    def get_all(self):
-        return self.seq
+    def __repr__(self):
+        return 'SFrame(%s)' % ','.join(self.names)
 
 
 class SchemeError(Exception):
@@ -148,10 +250,14 @@ def main_entry():
     from .evaluator import Evaluator
 
     sys.path.append(os.getcwd())  # for finding extension module
-    eva = Evaluator()
-    if len(sys.argv) > 1:
+    args = sys.argv[1:]
+    no_cache = '--no-cache' in args  # don't write .scmc files, see cache.py
+    if no_cache:
+        args.remove('--no-cache')
+    eva = Evaluator(cache=False if no_cache else None)
+    if args:
         try:
-            eva.load_file(sys.argv[1])
+            eva.load_file(args[0])
         except (SchemeError, FileNotFoundError) as e:
             print('Error: %s' % e, file=sys.stderr)
             sys.exit(-1)
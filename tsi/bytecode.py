@@ -0,0 +1,88 @@
+"""Bytecode run by the evaluator. An instruction is a tuple (opcode, arg),
+and jump targets are indexes of instructions. The evaluator keeps a value
+stack, instructions may pop their operands and push their result there."""
+
+# opcodes, roughly ordered by frequency (the evaluator tests them in order)
+(CALL_SIMPLE,  # arg is (SGlobalRef, instructions, CALL or TAIL_CALL), make the
+               # call without pushing the procedure and operands to the stack,
+               # operands are got by running instructions (LOCAL0, CONST, etc.)
+ CALL,  # pop procedure and arg operands, push the result
+ TAIL_CALL,  # same as CALL, but the callee returns to our caller
+ SELF_TAIL_CALL,  # same as TAIL_CALL, but the frame is reused if the callee is the
+                  # running procedure and nothing else refers to the frame
+ GLOBAL_REF,  # push the variable arg (SGlobalRef), using its cache
+ JUMP_IF_FALSE,  # pop, jump to arg if it's false
+ LOCAL0,  # push slot arg of the current frame (a parameter)
+ RETURN,  # return top of stack to the caller
+ LOCAL_REF,  # push variable at (depth, slot, name) checking it's assigned
+ CONST,  # push arg
+ JUMP,  # jump to arg
+ POP,  # discard top of stack
+ ENTER,  # arg is (names, n, padding), pop n values and make a frame of them
+         # followed by padding, enclosed by the current one, as the current
+ LEAVE,  # make the enclosing of the current frame the current one
+ NEXT,  # pop arg values to be the values of the current frame, for the next
+        # iteration of a loop, replacing the frame if anything refers to it
+ JUMP_IF_FALSE_OR_POP,  # jump to arg if top is false, else pop it
+ JUMP_IF_TRUE_OR_POP,  # jump to arg if top is true, else pop it
+ MAKE_CLOSURE,  # push a procedure made from arg: (SExpLambda, Code)
+ SET,  # assign top to variable arg, replace top by nil
+ DEFINE,  # define variable arg as top, replace top by nil
+ CAPTURE,  # push the continuation of the CALL/TAIL_CALL that follows
+ ESCAPE,  # put an escape continuation below top, and push it as well
+ ESCAPE_END,  # pop the value, end the escape continuation below and push back
+ GUARD,  # arg is (guards, n), jump to n unless every (SGlobalRef, value) in
+         # guards still has the value
+ ) = range(24)
+
+opnames = ('CALL_SIMPLE', 'CALL', 'TAIL_CALL', 'SELF_TAIL_CALL', 'GLOBAL_REF',
+           'JUMP_IF_FALSE', 'LOCAL0', 'RETURN', 'LOCAL_REF', 'CONST', 'JUMP',
+           'POP', 'ENTER', 'LEAVE', 'NEXT', 'JUMP_IF_FALSE_OR_POP',
+           'JUMP_IF_TRUE_OR_POP', 'MAKE_CLOSURE', 'SET', 'DEFINE', 'CAPTURE', 'ESCAPE',
+           'ESCAPE_END', 'GUARD')
+
+
+class Code:
+    """Compiled body of a procedure (or some top level expressions)."""
+    def __init__(self, name=None):
+        self.instructions = []
+        self.name = name
+        # number of frames entered by let forms at the current point, a
+        # self tail call can only reuse the frame of the procedure itself
+        self.lets = 0
+
+    def __str__(self):
+        lines = ['code %s:' % (self.name or '')]
+        for i, (op, arg) in enumerate(self.instructions):
+            if op == MAKE_CLOSURE:
+                arg = arg[1].name
+            lines.append('%4d %-20s %s' % (i, opnames[op], '' if arg is None else arg))
+        return '\n'.join(lines)
+
+    def emit(self, op, arg=None):
+        """Append an instruction and return its index."""
+        self.instructions.append((op, arg))
+        return len(self.instructions) - 1
+
+    def emit_return(self, tail):
+        if tail:
+            self.emit(RETURN)
+
+    def patch(self, idx):
+        """Let the jump at idx jump to the next instruction to be emitted."""
+        self.instructions[idx] = (self.instructions[idx][0], len(self.instructions))
+
+    def compile(self, exp, tail=False):
+        """Compile a (sub) expression."""
+        exp.compile(self, tail)
+
+    def compile_body(self, body, tail=True):
+        """Compile a sequence, whose value is the value of the last one."""
+        for exp in body[:-1]:
+            self.compile(exp)
+            self.emit(POP)
+        self.compile(body[-1], tail)
+
+    def finish(self):
+        self.instructions = tuple(self.instructions)
+        return self
@@ -0,0 +1,176 @@
+"""On-disk cache of analyzed code of loaded files, so loading a file again
+skips reading and analyzing it. The cache of x.scm is x.scmc, holding a
+fixed-size header that tells which source it was made from, then the
+analyzed top level expressions, each pickled on its own so that they can be
+loaded (and evaluated) one at a time.
+
+Unpickling runs code, so a cache is trusted like its source: anyone who
+can write the directory of a source can make the interpreter run anything
+when it's loaded. Caches owned by another user or writable by others are
+ignored, but loading from directories writable by untrusted users should
+be done with Evaluator(cache=False)."""
+import hashlib
+import os
+import pickle
+import struct
+import tempfile
+from . import __version__, SchemeError
+from .expression import SInputPort, analyze
+
+MAGIC = b'TSIC'
+# bumped when the pickled classes change incompatibly
+FORMAT = 3
+SUFFIX = 'c'
+
+# magic, format, version of tsi, then mtime (ns), size and SHA-256 of the
+# source. Nothing is unpickled before the header is checked
+_header_struct = struct.Struct('<4sH16sqq32s')
+_version = __version__.encode()
+
+_failures = (pickle.PicklingError, TypeError, AttributeError, RecursionError)
+
+
+def cache_path(path):
+    return path + SUFFIX
+
+
+def purge(path):
+    """Remove the cache of the source at path, if any."""
+    try:
+        os.remove(cache_path(path))
+    except FileNotFoundError:
+        pass
+
+
+def _header(stat, digest):
+    return _header_struct.pack(MAGIC, FORMAT, _version, stat.st_mtime_ns, stat.st_size, digest)
+
+
+def _digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            h.update(block)
+    return h.digest()
+
+
+def _trusted(f):
+    """Whether the cache file f is ours and only writable by us."""
+    if not hasattr(os, 'getuid'):  # no owners to check
+        return True
+    stat = os.fstat(f.fileno())
+    return stat.st_uid == os.getuid() and not stat.st_mode & 0o022
+
+
+def _valid(path, stat, f):
+    """Whether f is a cache of the source at path as it is now. The source
+    is only hashed if it has the size of the cached one but another mtime
+    (e.g. after a checkout)."""
+    data = f.read(_header_struct.size)
+    if len(data) != _header_struct.size:
+        return False
+    magic, fmt, version, mtime, size, digest = _header_struct.unpack(data)
+    if (magic, fmt, version.rstrip(b'\0'), size) != (MAGIC, FORMAT, _version, stat.st_size):
+        return False
+    if mtime == stat.st_mtime_ns:
+        return True
+    if digest != _digest(path):
+        return False
+    try:  # so the source isn't hashed again next time
+        with open(cache_path(path), 'r+b') as out:
+            out.write(_header(stat, digest))
+    except OSError:
+        pass
+    return True
+
+
+def expressions(path, enabled=True):
+    """Yield the analyzed top level expressions of the file at path. They
+    are loaded from its cache if it's valid, otherwise analyzed from the
+    source and the cache is written once all of them have been yielded."""
+    stat = os.stat(path)
+    if enabled:
+        try:
+            f = open(cache_path(path), 'rb')
+        except OSError:
+            f = None
+        if f is not None:
+            with f:
+                if _trusted(f) and _valid(path, stat, f):
+                    while True:
+                        try:
+                            yield pickle.load(f)
+                        except EOFError:
+                            return
+    yield from _analyze(path, stat, enabled)
+
+
+def _analyze(path, stat, enabled):
+    port = SInputPort.from_file(path)
+    out = _Writer(path, stat) if enabled else None
+    expressions = (analyze(i) for i in port.expressions())
+    try:
+        for exp in expressions:
+            if out is not None:
+                out.dump(exp)  # before evaluating, which leaves caches in exp
+            yield exp
+        if out is not None:
+            out.commit()
+    except GeneratorExit:
+        # evaluation has stopped (e.g. by an error), the rest is analyzed
+        # just to complete the cache
+        if out is not None:
+            try:
+                for exp in expressions:
+                    out.dump(exp)
+                out.commit()
+            except SchemeError:
+                pass
+        raise
+    finally:
+        port.close()
+        if out is not None:
+            out.abort()
+
+
+class _Writer:
+    """Writes a cache to a temporary file of its own, which replaces the
+    cache once committed, so threads and processes writing the same cache
+    don't mix. Nothing is written if an expression can't be pickled, and
+    failing to write (e.g. a read-only directory) isn't an error."""
+    def __init__(self, path, stat):
+        self.path = cache_path(path)
+        self.file = None
+        try:
+            # mode 0600, so not writable by others, see _trusted
+            directory, name = os.path.split(self.path)
+            fd, self.tmp = tempfile.mkstemp('.tmp', name + '.', directory or '.')
+            self.file = os.fdopen(fd, 'wb')
+            self.file.write(_header(stat, _digest(path)))
+        except OSError:
+            self.abort()
+
+    def dump(self, obj):
+        if self.file is not None:
+            try:
+                pickle.dump(obj, self.file, pickle.HIGHEST_PROTOCOL)
+            except _failures + (OSError,):
+                self.abort()
+
+    def commit(self):
+        if self.file is not None:
+            try:
+                self.file.close()
+                os.replace(self.tmp, self.path)
+            except OSError:
+                self.abort()
+            self.file = None
+
+    def abort(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            try:
+                os.remove(self.tmp)
+            except OSError:
+                pass
@@ -1,32 +1,56 @@
 import os
 import sys
-from copy import copy
-from collections import deque, Iterable
-from . import (__version__, SEnvironment, EvalRequest, ContinuationInvoked,
-               SObject, SchemeError, SExp)
+from . import (__version__, SExp, SEnvironment, SFrame, ContinuationInvoked, SchemeError,
+               SProc, SPrimitiveProc, SCompoundProc, TailCall, unassigned)
+from .bytecode import *
 from .parser import parse, parse_input
-from .expression import theNil, analyze, theTrue, theFalse
+from .expression import (theNil, analyze, theTrue, theFalse, SExpCallCc, SExpCallEc,
+                         Optimizer, SOutputPort, SInputPort)
 from .primitives import prim_proc_name_imp
+from . import cache
+
+
+# code of the frame made for TailCall.then, with then and the result of the
+# call on the stack
+_callback = ((TAIL_CALL, 1), (RETURN, None))
+
+# frozen layers of the global variables with primitives and stdlib, and
+# the environment they were defined in, by optimize, see _setup_global_env
+_images = {}
 
 
 class Evaluator:
-    def __init__(self):
+    def __init__(self, optimize=False, output=None, cache=None):
         # interactive mode settings
         self.in_prompt = '>> '
+        # fold constants and remove dead code before compiling
+        self.optimize = optimize
+        self.nodes_removed = 0  # by the optimization so far
+        # keep analyzed code of loaded files on disk (see cache.py), by
+        # default unless the environment variable TSI_NO_CACHE is set
+        self.cache = not os.environ.get('TSI_NO_CACHE') if cache is None else cache
+        # the current output port, flushed when evaluation returns, so its
+        # buffer only holds output of the running program
+        self.output = output or SOutputPort()
+        self.input = SInputPort(lambda: sys.stdin.readline())  # current input port
+
+        # number of continuations captured, see RETURN in _execute
+        self._captures = 0
+        # escape continuations in their extent, innermost last
+        self._escapes = []
 
-        self._stack = None
-        self._global_env = SEnvironment()
         self._setup_global_env()
 
     def driver_loop(self):
         """The read-eval-print loop."""
         print('Toy Scheme Interpreter v%s  (EOF to exit)' % __version__)
         while True:
-            print(self.in_prompt, end='')
+            self.output.write(self.in_prompt)
+            self.output.flush()
             try:
                 out = self._eval(analyze(parse_input()), self._global_env)
                 if out is not theNil:
-                    print(out)
+                    self.output.write('%s\n' % out)
             except KeyboardInterrupt:
                 print()
             except EOFError:
@@ -43,97 +67,312 @@ class Evaluator:
         analyzed = map(analyze, parse(s))
         return self._eval(analyzed, self._global_env)
 
+    def compile(self, ast):
+        """Compile top level expressions (an analyzed one or an iterable of
+        them), the value of the code is the value of the last one."""
+        ast = (ast,) if isinstance(ast, SExp) else tuple(ast)  # strings are iterable
+        if self.optimize:
+            optimizer = Optimizer(self._global_env)
+            ast = tuple(map(optimizer, ast))
+            self.nodes_removed += optimizer.removed
+        code = Code('top-level')
+        code.compile_body(ast)
+        return code.finish()
+
     def _eval(self, ast, env):
         # this method should not be called recursively
-        self._stack = deque(list(ast)[::-1] if isinstance(ast, Iterable) else [ast])
-        call_cc_value = None  # the value of (call/cc <proc>)
+        state = (self.compile(ast).instructions, 0, env, [], None)
+        try:
+            while True:
+                try:
+                    return self._execute(*state)
+                except ContinuationInvoked as e:
+                    instructions, pc, env, stack, frames = e.args[0]
+                    # the value of (call/cc <proc>)
+                    state = (instructions, pc, env, list(stack) + [e.args[1]], frames)
+        finally:
+            # left by an error or a continuation
+            self._end_escapes()
+            self.output.flush()
 
-        while True:
-            try:
-                return self._eval_iterator(ret=call_cc_value)
-            except ContinuationInvoked as e:
-                self.restore_snapshot(e.args[0])
-                call_cc_value = e.args[1]
-
-    def _eval_iterator(self, ret=None):
-        """The eval, but only EvalRequest handled here. This part is aimed only to
-        break Python's recursion limit, and method used is known as "trampoline".
-        The real implementation of expressions is in SExp.__call__."""
-        # apply still alive, it's hiding in SExpApplication
+    def _end_escapes(self, escape=None):
+        """End the extent of an escape continuation and those inside it, or
+        of all of them."""
+        escapes = self._escapes
+        while escapes:
+            inner = escapes.pop()
+            inner.live = False
+            if inner is escape:
+                break
+
+    def _execute(self, instructions, pc, env, stack, frames):
+        """The eval, a loop running instructions. Procedure calls save the
+        caller as a frame (caller's frame, instructions, pc, env, stack,
+        captures) instead of recursion, so there's no stack overflow. Every
+        call gets a new value stack. Frames are never modified, so call/cc
+        just keeps the current one, and the only thing to copy is the value
+        stack of the frame being returned to, if it may be shared with a
+        continuation. The real implementation of expressions is in
+        SExp.compile."""
         # sys.setrecursionlimit wins if we can set stack limit of interpreter...
-        def push_new_req(req, caller):
-            nonlocal env
-            req.caller = caller
-            env = req.env
-            stack.append(req)
-
-        stack, env = self._stack, self._global_env
-        while stack:
-            e = stack.pop()  # instance of SExp or EvalReq
-            if e.__class__ == EvalRequest:
-                if e.idx != -1:  # retrieve evaluated exp (except the first time)
-                    e.seq[e.idx] = ret
-
-                if e.idx < len(e.seq) - 2 or (e.idx == len(e.seq) - 2 and not e.as_value):
-                    e.idx += 1
-                    stack.extend((e, e.seq[e.idx]))  # pushing of new EvalReq may happen here
-                    env = e.env
-                else:  # request finished
-                    if e.idx == len(e.seq) - 2 and e.as_value:
-                        # Not eval the last expression, but let it be the value of
-                        # the caller. This prevent stack from growing and achieved TCO.
-                        caller = e.seq[-1]
-                        ret = caller(e.env, self)
-                    else:  # pass result back
-                        caller = e.caller
-                        ret = caller(e.env, self, e)
-
-                    if ret.__class__ == EvalRequest:
-                        push_new_req(ret, caller)
-            else:
-                obj = e(env, self)
-                if obj.__class__ == EvalRequest:
-                    push_new_req(obj, e)
+        append, pop = stack.append, stack.pop
+        global_env, ancestors = self._global_env, self._ancestors
+        while True:
+            op, arg = instructions[pc]
+            pc += 1
+            if op == CALL_SIMPLE or op == CALL or op == TAIL_CALL or op == SELF_TAIL_CALL:
+                if op == CALL_SIMPLE:
+                    # the same as running the instructions then CALL/TAIL_CALL
+                    proc, simple, op = arg
+                    top = env.top
+                    cache = proc._cache
+                    if cache[0] is top and cache[1] == SEnvironment.version:
+                        proc = cache[2].value
+                    else:
+                        proc = proc.lookup(top)
+                    operands = []
+                    for sop, sarg in simple:
+                        if sop == LOCAL0:
+                            operands.append(env.values[sarg])
+                        elif sop == CONST:
+                            operands.append(sarg)
+                        elif sop == GLOBAL_REF:
+                            cache = sarg._cache
+                            if cache[0] is top and cache[1] == SEnvironment.version:
+                                operands.append(cache[2].value)
+                            else:
+                                operands.append(sarg.lookup(top))
+                        else:  # LOCAL_REF
+                            depth, slot, name = sarg
+                            frame = env
+                            while depth:
+                                frame = frame.enclosing
+                                depth -= 1
+                            value = frame.values[slot]
+                            if value is unassigned:
+                                raise SchemeError('Unbound variable (%s)' % name)
+                            operands.append(value)
                 else:
-                    ret = obj
-
-        assert isinstance(ret, SObject)
-        return ret
-
-    def take_snapshot(self):
-        # Can't 100% sure what to copy and how deep to copy, bugs may still
-        # exists. Forcing control flags of EvalReq to be immutable is a bad
-        # idea.
-        def copy_stack(x):
-            if x.__class__ == EvalRequest:
-                req = copy(x)  # shallow copy
-                req.seq = copy(x.seq)
-                return req
+                    n = len(stack) - arg
+                    proc, operands = stack[n - 1], stack[n:]
+                    del stack[n - 1:]
+                while True:
+                    if proc.__class__ == SCompoundProc:
+                        if proc.nparams != len(operands):
+                            raise SchemeError('Wrong number of args (%s)' % str(proc), 'APPLY')
+                        if proc.padding:
+                            operands.extend(proc.padding)
+                        if op == CALL:
+                            frames = (frames, instructions, pc, env, stack, self._captures)
+                            stack = []
+                            append, pop = stack.append, stack.pop
+                        elif (op == SELF_TAIL_CALL and proc.code.instructions is instructions and
+                              proc.env is env.enclosing and env.epoch == self._captures):
+                            # a loop, just rebind the parameters
+                            env.values = operands
+                            pc = 0
+                            break
+                        # eliminate all tail calls, including tail recursion
+                        env = SFrame(proc.env, proc.frame_names, operands, self._captures)
+                        if env.top is not global_env and env.top in ancestors:
+                            env.top = global_env  # made before cloning, see clone
+                        instructions, pc = proc.code.instructions, 0
+                        break
+                    if proc.__class__ != SPrimitiveProc:
+                        if proc.__class__ == SExpCallEc.SEscape:
+                            if len(operands) > 1:
+                                raise SchemeError('Too many argument for continuation')
+                            if not proc.live:
+                                raise SchemeError('Escape continuation used after its extent')
+                            self._end_escapes(proc)
+                            frames, instructions, pc, env, stack, height = proc.resume
+                            # the stack may be shared with a continuation
+                            stack = stack[:height]
+                            stack.append(operands[0] if operands else theNil)
+                            append, pop = stack.append, stack.pop
+                            break
+                        if not isinstance(proc, SProc):
+                            raise SchemeError('Unknown procedure type (%s)' % str(proc), 'APPLY')
+                    ret = proc.apply(operands, env, self)
+                    if ret.__class__ != TailCall:
+                        append(ret)  # TAIL_CALL is followed by RETURN
+                        break
+                    proc, operands = ret.proc, list(ret.operands)
+                    if ret.then is not None:
+                        # make the call from a frame that passes the result
+                        # to then, which returns in place of this call
+                        if op == CALL:
+                            frames = (frames, instructions, pc, env, stack, self._captures)
+                        instructions, pc, stack, op = _callback, 0, [ret.then], CALL
+                        append, pop = stack.append, stack.pop
+            elif op == GLOBAL_REF:
+                top = env.top
+                cache = arg._cache
+                if cache[0] is top and cache[1] == SEnvironment.version:
+                    append(cache[2].value)
+                else:
+                    append(arg.lookup(top))
+            elif op == JUMP_IF_FALSE:
+                if pop() is theFalse:
+                    pc = arg
+            elif op == LOCAL0:
+                append(env.values[arg])
+            elif op == RETURN:
+                value = stack[-1]
+                if frames is None:
+                    return value
+                frames, instructions, pc, env, stack, captures = frames
+                if captures != self._captures:
+                    stack = list(stack)  # a continuation may refer to it
+                stack.append(value)
+                append, pop = stack.append, stack.pop
+            elif op == LOCAL_REF:
+                depth, slot, name = arg
+                frame = env
+                while depth:
+                    frame = frame.enclosing
+                    depth -= 1
+                value = frame.values[slot]
+                if value is unassigned:
+                    raise SchemeError('Unbound variable (%s)' % name)
+                append(value)
+            elif op == CONST:
+                append(arg)
+            elif op == JUMP:
+                pc = arg
+            elif op == POP:
+                pop()
+            elif op == ENTER:
+                names, n, padding = arg
+                n = len(stack) - n
+                values = stack[n:]
+                del stack[n:]
+                if padding:
+                    values.extend(padding)
+                env = SFrame(env, names, values, self._captures)
+            elif op == LEAVE:
+                env = env.enclosing
+            elif op == NEXT:
+                n = len(stack) - arg
+                values = stack[n:]
+                del stack[n:]
+                if env.epoch == self._captures:
+                    env.values = values
+                else:  # a closure or continuation refers to this iteration
+                    env = SFrame(env.enclosing, env.names, values, self._captures)
+            elif op == JUMP_IF_FALSE_OR_POP:
+                if stack[-1] is theFalse:
+                    pc = arg
+                else:
+                    pop()
+            elif op == JUMP_IF_TRUE_OR_POP:
+                if stack[-1] is not theFalse:
+                    pc = arg
+                else:
+                    pop()
+            elif op == MAKE_CLOSURE:
+                lambda_exp, code = arg
+                frame = env
+                # never reuse the frame, nor those it's in (e.g. the procedure
+                # frame around a let), whose ancestors are marked already
+                while frame.__class__ == SFrame and frame.epoch != -1:
+                    frame.epoch = -1
+                    frame = frame.enclosing
+                append(SCompoundProc(lambda_exp.parameters, code, env, lambda_exp.frame_names))
+            elif op == SET:
+                arg.assign(env, stack[-1])
+                stack[-1] = theNil
+            elif op == DEFINE:
+                value = stack[-1]
+                if value.__class__ == SCompoundProc and value.name is None:
+                    value.name = arg.name
+                arg.define(env, value)
+                stack[-1] = theNil
+            elif op == CAPTURE:
+                # resume after the call, with the procedure popped
+                snapshot = (instructions, pc + 1, env, tuple(stack[:-1]), frames)
+                self._captures += 1
+                append(SExpCallCc.SContinuation(snapshot))
+            elif op == ESCAPE:
+                # resume at ESCAPE_END, with the procedure and itself popped
+                escape = SExpCallEc.SEscape((frames, instructions, pc + 1, env, stack, len(stack)))
+                stack.insert(-1, escape)
+                append(escape)
+                self._escapes.append(escape)
+            elif op == ESCAPE_END:
+                value = pop()
+                escape = pop()
+                if escape.live:
+                    self._end_escapes(escape)
+                append(value)
+            elif op == GUARD:
+                guards, target = arg
+                for ref, value in guards:
+                    if ref.lookup(env) is not value:
+                        pc = target
+                        break
             else:
-                assert isinstance(x, SExp)
-                return x
-
-        return tuple(map(copy_stack, self._stack))
-
-    def restore_snapshot(self, snapshot):
-        self._stack = deque(snapshot)
+                raise SchemeError('Bad instruction (%s)' % op)
 
     def load_file(self, path, env=None):
-        """Execute a script in the environment."""
+        """Execute a script in the environment. Expressions are read and
+        evaluated one at a time, so only one is kept in memory."""
         if not path.endswith('.scm'):
             path += '.scm'
-        with open(path, encoding='utf-8') as f:
-            return self._eval(map(analyze, parse(f.read())),
-                              env or self._global_env)
+        expressions = cache.expressions(path, self.cache)
+        try:
+            value = theNil
+            for exp in expressions:
+                value = self._eval(exp, env or self._global_env)
+            return value
+        finally:
+            expressions.close()
 
     def _setup_global_env(self):
-        self._global_env.extend(prim_proc_name_imp)
-        self._global_env.extend((('true', theTrue), ('false', theFalse), ('#t', theTrue),
-                                 ('#f', theFalse), ('nil', theNil)))
-        # load stdlib
-        self.load_file(os.path.join(os.path.dirname(__file__), 'stdlib.scm'))
+        # the environment is set up once for each way of compiling, then
+        # evaluators start with its variables frozen, as if cloned
+        image = _images.get(self.optimize)
+        if image is None:
+            self._global_env, self._ancestors = SEnvironment(), frozenset()
+            self._global_env.extend(prim_proc_name_imp)
+            self._global_env.extend((('true', theTrue), ('false', theFalse), ('#t', theTrue),
+                                     ('#f', theFalse), ('nil', theNil)))
+            # load stdlib
+            self.load_file(os.path.join(os.path.dirname(__file__), 'stdlib.scm'))
+            image = _images[self.optimize] = self._freeze()
+        self._global_env = SEnvironment()
+        self._global_env.layers, self._ancestors = image
+
+    def _freeze(self):
+        """Move the global variables into a new frozen layer, and return the
+        layers and the environments whose procedures refer to them."""
+        env = self._global_env
+        if env.vars:
+            env.layers = (env.vars,) + env.layers
+            env.vars = {}
+        return env.layers, self._ancestors | {env}
+
+    def clone(self):
+        """Return an evaluator with the same settings and global variables,
+        whose global variables are isolated from this one: what either
+        defines or sets at top level is only seen by itself. The variables
+        so far are frozen and shared, so cloning takes the same time however
+        many there are.
+
+        Procedures made before cloning refer to the global environment of
+        this evaluator (one of the ancestors of the clone), so calls to them
+        in the clone look up global variables in its own environment.
+
+        Only global variables are copied on write. Objects are not copied:
+        mutating a pair, vector, string or hash table, or setting a variable
+        bound in a procedure made before cloning (e.g. a counter over a
+        let), is seen by this evaluator and all of its clones. State of a
+        library that clones shouldn't share belongs in global variables."""
+        layers, ancestors = self._freeze()
+        other = Evaluator(self.optimize, self.output, self.cache)
+        other.in_prompt, other.input = self.in_prompt, self.input
+        other._global_env.layers, other._ancestors = layers, ancestors
+        return other
 
     def reset(self):
-        self._stack = None
-        self._global_env = SEnvironment()
         self._setup_global_env()
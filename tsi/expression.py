@@ -1,10 +1,29 @@
+import codecs
+import io
+import mmap
+import os
 import re
-from . import (EvalRequest, SObject, SExp, SProc, SCompoundProc,
-               ContinuationInvoked, SchemeError)
+import sys
+import threading
+import weakref
+from array import array
+from . import (SObject, SExp, SProc, SPrimitiveProc, SCompoundProc, SEnvironment,
+               ContinuationInvoked, SchemeError, unassigned, TailCall)
+from .bytecode import *
+from .parser import IncompleteInputError, Reader, read_datum
 
 
 class SSelfEvalExp(SExp):
-    def __call__(self, *__):
+    simple = True
+
+    def instruction(self):
+        return CONST, self
+
+    def compile(self, code, tail=False):
+        code.emit(CONST, self)
+        code.emit_return(tail)
+
+    def constant(self):
         return self
 
 
@@ -43,30 +62,158 @@ class STrue(SBool):
     def __str__(self):
         return '#t'
 
+    def __reduce__(self):
+        return 'theTrue'
+
 
 class SFalse(SBool):
     def __str__(self):
         return '#f'
 
+    def __reduce__(self):
+        return 'theFalse'
+
+
+class SSymbol(SObject):
+    """Symbols are interned, there's only one symbol of each name, so they
+    are compared by identity."""
+    # name -> symbol, symbols nothing refers to are dropped (e.g. those read
+    # from data). Symbols are added under the lock, so threads interning the
+    # same name get the same one
+    _table = weakref.WeakValueDictionary()
+    _lock = threading.Lock()
+
+    def __new__(cls, name):
+        symbol = cls._table.get(name)
+        if symbol is None:
+            with cls._lock:
+                symbol = cls._table.get(name)
+                if symbol is None:
+                    symbol = super().__new__(cls)
+                    symbol.name = name
+                    cls._table[name] = symbol
+        return symbol
+
+    def __reduce__(self):
+        return SSymbol, (self.name,)
+
+    def __str__(self):
+        return self.name
+
+
+class SVariable(SExp):
+    """Variable reference made by analyze, see make_variable."""
+    simple = True
 
-class SSymbol(SExp):
     def __init__(self, exp):
         self.name = exp
 
-    def __call__(self, env, *__):
-        return env.get_var_value(self.name)
-
     def __str__(self):
         return self.name
 
-    def __eq__(self, other):
-        return isinstance(other, SSymbol) and self.name == other.name
+
+class SLocalRef(SVariable):
+    """Variable bound by an enclosing lambda, addressed as (depth, slot):
+    follow "depth" enclosing links, then index the frame. Slots of internal
+    definitions may be unassigned, so they are "checked"."""
+    def __init__(self, exp, depth, slot, checked):
+        super().__init__(exp)
+        self.depth, self.slot, self.checked = depth, slot, checked
+
+    def _frame(self, env):
+        depth = self.depth
+        while depth:
+            env = env.enclosing
+            depth -= 1
+        return env
+
+    def lookup(self, env):
+        value = self._frame(env).values[self.slot]
+        if value is unassigned:
+            raise SchemeError('Unbound variable (%s)' % self.name)
+        return value
+
+    def assign(self, env, value):
+        self._frame(env).values[self.slot] = value
+
+    define = assign
+
+    def instruction(self):
+        if self.depth == 0 and not self.checked:
+            return LOCAL0, self.slot
+        return LOCAL_REF, (self.depth, self.slot, self.name)
+
+    def compile(self, code, tail=False):
+        code.emit(*self.instruction())
+        code.emit_return(tail)
+
+
+class SGlobalRef(SVariable):
+    """Variable that is free in all enclosing lambdas (or at top level), so
+    it's looked up by name in the nearest dict-backed environment.
+
+    Lookups are cached: the cell found is kept together with the environment
+    and SEnvironment.version, in one tuple so that it's replaced at once
+    (evaluators may run in threads), and reused while both match."""
+    _cache = (None, -1, None)  # (environment, version, cell)
+
+    def __getstate__(self):
+        return {'name': self.name}  # without the cached lookup
+
+    def lookup(self, env):
+        env = env.top
+        cache = self._cache
+        if cache[0] is env and cache[1] == SEnvironment.version:
+            return cache[2].value
+        version = SEnvironment.version
+        cell = env.get_cell(self.name)
+        self._cache = (env, version, cell)
+        return cell.value
+
+    def assign(self, env, value):
+        env.top.set_var_value(self.name, value)
+
+    def define(self, env, value):
+        env.top.def_var(self.name, value)
+
+    def instruction(self):
+        return GLOBAL_REF, self
+
+    def compile(self, code, tail=False):
+        code.emit(GLOBAL_REF, self)
+        code.emit_return(tail)
+
+
+class Scope:
+    """Analyze time view of a procedure frame: names of its slots, and the
+    scope of the enclosing lambda."""
+    def __init__(self, names, parent=None):
+        self.names = list(names)
+        self.nparams = len(self.names)
+        self.parent = parent
+
+    def declare(self, name):
+        if name not in self.names:
+            self.names.append(name)
+
+    def resolve(self, name):
+        """Return the variable expression for name used in this scope."""
+        depth, scope = 0, self
+        while scope is not None:
+            if name in scope.names:
+                slot = scope.names.index(name)
+                return SLocalRef(name, depth, slot, slot >= scope.nparams)
+            depth, scope = depth + 1, scope.parent
+        return SGlobalRef(name)
 
 
 class SNil(SObject):
     def __str__(self):
         return '()'
 
+    def __reduce__(self):
+        return 'theNil'
+
     def to_py_list(self):
         return []
 
@@ -76,55 +223,516 @@ class SPair(SObject):
         self.car, self.cdr = car, cdr
 
     def __str__(self):
-        def walker(curt):
-            """If it's a list, return all of its elements."""
-            if isinstance(curt.cdr, SPair):
-                return [curt.car] + walker(curt.cdr)
-            elif curt.cdr is theNil:
-                return [curt.car]
-            else:
-                return [curt.car, '.', curt.cdr]  # pair or not well-formed list
-
-        return '(%s)' % ' '.join(map(str, walker(self)))
+        out = io.StringIO()
+        write(self, out)
+        return out.getvalue()
 
     def __eq__(self, other):
-        return (isinstance(other, SPair) and self.car == other.car and
-                self.cdr == other.cdr)
+        return is_equal(self, other)
+
+    def __reduce__(self):
+        # pickled as the elements and the tail, so long lists don't make
+        # pickle recurse for each pair
+        items, lst, seen = [], self, set()
+        while lst.__class__ == SPair and id(lst) not in seen:
+            seen.add(id(lst))
+            items.append(lst.car)
+            lst = lst.cdr
+        return SPair.make_list, (items, lst)
 
     def to_py_list(self):
-        return [self.car] + (self.cdr.to_py_list() if self.cdr != theNil else [])
+        result, lst = [], self
+        while lst.__class__ == SPair:
+            result.append(lst.car)
+            lst = lst.cdr
+        if lst is not theNil:
+            raise SchemeError('Not a proper list')
+        return result
 
     @staticmethod
-    def make_list(seq):
-        return SPair(seq[0], SPair.make_list(seq[1:])) if seq else theNil
+    def make_list(seq, tail=None):
+        """Return a list of the elements of seq, followed by tail (nil by
+        default)."""
+        lst = theNil if tail is None else tail
+        for i in reversed(seq):
+            lst = SPair(i, lst)
+        return lst
+
+
+def _cycle_entries(obj):
+    """Return ids of pairs and vectors reachable from obj that are reached
+    again from inside themselves, in the order write visits them."""
+    entries, path, done = set(), set(), set()
+    stack = [(obj, False)]
+    while stack:
+        obj, leaving = stack.pop()
+        key = id(obj)
+        if leaving:
+            path.remove(key)
+            done.add(key)
+        elif key in path:
+            entries.add(key)
+        elif key not in done:
+            if obj.__class__ == SPair:
+                children = (obj.cdr, obj.car)
+            elif obj.__class__ == SVector:
+                children = reversed(obj.items)
+            else:
+                continue
+            path.add(key)
+            stack.append((obj, True))
+            stack.extend((i, False) for i in children)
+    return entries
+
+
+_items_iterator = type(iter([]))
+
+
+def write(obj, out, chunk_size=4096):
+    """Write the text representation of obj to file object out, in chunks
+    made of about chunk_size atoms and parentheses. Pairs and vectors in
+    cycles (made by set-cdr! and the like) are written with datum labels:
+    #0=(1 . #0#)."""
+    entries = _cycle_entries(obj)
+    labels = {}
+    chunk = []
+    # the rest of each list (or iterator of each vector) being written,
+    # innermost last
+    rests = []
+    end = object()
+    while True:
+        # write obj, down to the first atom or label
+        while True:
+            if obj.__class__ != SPair and obj.__class__ != SVector:
+                chunk.append(str(obj))
+                break
+            key = id(obj)
+            if key in labels:
+                chunk.append('#%d#' % labels[key])
+                break
+            if key in entries:
+                labels[key] = len(labels)
+                chunk.append('#%d=' % labels[key])
+            if obj.__class__ == SPair:
+                chunk.append('(')
+                rests.append(obj.cdr)
+                obj = obj.car
+            else:
+                items = iter(obj.items)
+                obj = next(items, end)
+                if obj is end:
+                    chunk.append('#()')
+                    break
+                chunk.append('#(')
+                rests.append(items)
+        if len(chunk) >= chunk_size:
+            out.write(''.join(chunk))
+            chunk = []
+        # go on with the innermost unfinished list or vector
+        while rests:
+            rest = rests.pop()
+            if rest is theNil:
+                chunk.append(')')
+            elif rest.__class__ == _items_iterator:
+                obj = next(rest, end)
+                if obj is end:
+                    chunk.append(')')
+                else:
+                    chunk.append(' ')
+                    rests.append(rest)
+                    break
+            elif rest.__class__ == SPair and id(rest) not in entries:
+                chunk.append(' ')
+                rests.append(rest.cdr)
+                obj = rest.car
+                break
+            else:  # not a proper list, or the rest is labeled
+                chunk.append(' . ')
+                rests.append(theNil)
+                obj = rest
+                break
+        else:
+            break
+    out.write(''.join(chunk))
+
+
+class SVector(SObject):
+    def __init__(self, items):
+        self.items = items  # a list
+
+    def __str__(self):
+        out = io.StringIO()
+        write(self, out)
+        return out.getvalue()
+
+
+class SNumVector(SObject):
+    """Homogeneous numeric vector (like SRFI 4), whose items are kept in
+    an array.array of typecode."""
+    typecode = tag = None
+    number = None  # type of the elements
+
+    def __init__(self, items):
+        self.items = array(self.typecode, items)
+
+    def __str__(self):
+        return '#%s(%s)' % (self.tag, ' '.join(str(self.number(i)) for i in self.items))
+
+
+class SF64Vector(SNumVector):
+    typecode, tag = 'd', 'f64'
+    number = SReal
+
+
+class SS64Vector(SNumVector):
+    typecode, tag = 'q', 's64'
+    number = SInteger
+
+
+class SRecordType(SObject):
+    """Made by define-record-type. Its instances are of a subclass of
+    SRecord made for it, which keeps the fields in slots."""
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        # field names aren't always Python identifiers
+        slots = tuple('f%d' % i for i in range(len(fields)))
+        self.cls = type(name, (SRecord,), {'__slots__': slots, 'type': self})
+
+    def __str__(self):
+        return '#<record-type %s>' % self.name
+
+
+class SRecord(SObject):
+    __slots__ = ()
+    type = None  # SRecordType
+
+    def __str__(self):
+        values = (getattr(self, i) for i in self.__slots__)
+        return '#<%s %s>' % (self.type.name, ' '.join(
+            '%s: %s' % i for i in zip(self.type.fields, values)))
+
+
+class SOutputPort(SObject):
+    """Text written to it is kept in a buffer, which is written to file
+    once it holds buffer_size characters, or when flushed. If file is None
+    it's sys.stdout at the time of flushing."""
+    def __init__(self, file=None, buffer_size=8192):
+        self.file = file
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._size = 0
+
+    def __str__(self):
+        return '#<output-port>'
+
+    def write(self, s):
+        self._buffer.append(s)
+        self._size += len(s)
+        if self._size >= self.buffer_size:
+            self.flush()
+
+    def close(self):
+        self.flush()
+
+    def flush(self):
+        file = self.file or sys.stdout
+        if self._buffer:
+            file.write(''.join(self._buffer))
+            self._buffer.clear()
+            self._size = 0
+        file.flush()
+
+
+class SStringOutputPort(SOutputPort):
+    """Made by open-output-string, keeps everything written to it."""
+    def __init__(self):
+        super().__init__(None, float('inf'))
+
+    def __str__(self):
+        return '#<string-output-port>'
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        value = ''.join(self._buffer)
+        self._buffer[:] = [value]
+        return value
+
+
+class SInputPort(SObject):
+    """Reads text got by calling read_block, which returns '' at the end.
+    Text is kept in a buffer until it's consumed, read reads an expression
+    taking no more text than needed."""
+    block_size = 1 << 16
+    mmap_threshold = 1 << 20  # files at least this large are mapped
+
+    def __init__(self, read_block, close=None, text=''):
+        self._read_block = read_block
+        self._close = close
+        self._text, self._pos = text, 0
+        self._end = False
+
+    def __str__(self):
+        return '#<input-port>'
+
+    @classmethod
+    def from_file(cls, path):
+        f = open(path, 'rb')
+        try:
+            if os.fstat(f.fileno()).st_size >= cls.mmap_threshold:
+                source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                source = f
+        except OSError:
+            f.close()
+            raise
+        decoder = codecs.getincrementaldecoder('utf-8')()
+
+        def read_block():
+            data = source.read(cls.block_size)
+            return decoder.decode(data, not data)
+
+        def close():
+            source.close()
+            f.close()
+        return cls(read_block, close)
+
+    def close(self):
+        if self._close:
+            self._close()
+
+        def closed():
+            raise SchemeError('Port is closed')
+        self._read_block, self._close = closed, None
+        self._text, self._pos, self._end = '', 0, False
+
+    def _fill(self):
+        """Read more text into the buffer, return False at the end."""
+        if self._end:
+            return False
+        text = self._read_block()
+        if not text:
+            self._end = True
+            return False
+        self._text = self._text[self._pos:] + text
+        self._pos = 0
+        return True
+
+    def read_char(self):
+        if self._pos == len(self._text) and not self._fill():
+            return theEof
+        self._pos += 1
+        return SString(self._text[self._pos - 1])
+
+    def peek_char(self):
+        if self._pos == len(self._text) and not self._fill():
+            return theEof
+        return SString(self._text[self._pos])
+
+    def read_line(self):
+        while True:
+            end = self._text.find('\n', self._pos)
+            if end != -1:
+                line = self._text[self._pos:end]
+                self._pos = end + 1
+                return SString(line)
+            if not self._fill():
+                if self._pos == len(self._text):
+                    return theEof
+                line = self._text[self._pos:]
+                self._pos = len(self._text)
+                return SString(line)
+
+    def read(self):
+        """Return the next expression like parse does, or None."""
+        return read_datum(self._next_token)
+
+    def expressions(self):
+        """Iterate the expressions left, like calling read until it returns
+        None but faster. The port is read ahead, so nothing is left for
+        other reads."""
+        reader = Reader(self._text[self._pos:], None if self._end else self._read_block)
+        self._text, self._pos, self._end = '', 0, True
+        return iter(reader)
+
+    _blank = re.compile(r'(?:\s+|;[^\n]*\n?)*')
+    # blanks and comments, then a token
+    _token = re.compile(r'''(?:\s+|;[^\n]*\n)*(\(|\)|"[^"]*"|'|[^()\s";]+)''')
+
+    def _next_token(self):
+        while True:
+            match = self._token.match(self._text, self._pos)
+            # a token reaching the end of the buffer may go on in the next
+            # block, as may blanks or a string if there's no match
+            if match is None or match.end() == len(self._text):
+                if self._fill():
+                    continue
+                if match is None:
+                    if self._blank.match(self._text, self._pos).end() < len(self._text):
+                        raise IncompleteInputError('Unterminated string')
+                    self._pos = len(self._text)
+                    return None
+            self._pos = match.end()
+            return match.group(1)
 
 
 is_true = lambda exp: exp is not theFalse
 is_false = lambda exp: exp is theFalse
 
 
-theTrue, theFalse, theNil = STrue(), SFalse(), SNil()
+def is_eq(x, y):
+    return x is y
+
+
+def is_eqv(x, y):
+    """Numbers of the same exactness are also compared by value."""
+    return x is y or (x.__class__ == y.__class__ and isinstance(x, SNumber) and x == y)
+
+
+def is_equal(x, y):
+    """Compare pairs, vectors and strings by contents, others by is_eqv.
+    Pairs (or vectors) already being compared are assumed equal, so cyclic
+    lists are fine."""
+    pending, compared = [(x, y)], set()
+    while pending:
+        x, y = pending.pop()
+        if x is y:
+            continue
+        if x.__class__ == SPair:
+            if y.__class__ != SPair:
+                return False
+            key = (id(x), id(y))
+            if key not in compared:
+                compared.add(key)
+                pending.append((x.cdr, y.cdr))
+                pending.append((x.car, y.car))
+        elif x.__class__ == SVector:
+            if y.__class__ != SVector or len(x.items) != len(y.items):
+                return False
+            key = (id(x), id(y))
+            if key not in compared:
+                compared.add(key)
+                pending.extend(zip(reversed(x.items), reversed(y.items)))
+        elif x.__class__ == SString:
+            if y.__class__ != SString or x != y:
+                return False
+        elif isinstance(x, SNumVector):
+            if y.__class__ != x.__class__ or x.items != y.items:
+                return False
+        elif not is_eqv(x, y):
+            return False
+    return True
+
+
+def equal_hash(x, limit=64):
+    """Hash consistent with is_equal, looking at no more than limit parts
+    of x, so it's quick for long or cyclic lists."""
+    h, pending = 0, [x]
+    while pending and limit:
+        x = pending.pop()
+        limit -= 1
+        if x.__class__ == SPair:
+            pending.append(x.cdr)
+            pending.append(x.car)
+            x = SPair
+        elif x.__class__ == SVector:
+            pending.extend(reversed(x.items[:limit]))
+            x = SVector, len(x.items)
+        elif isinstance(x, SNumVector):
+            x = x.__class__, len(x.items), tuple(x.items[:limit])
+        h = hash((h, x))
+    return h
+
+
+class SHashTable(SObject):
+    """Hash table made by make-hash-table, a dict whose keys are made from
+    the Scheme keys by key_eqv or key_equal. Values of the dict are (key,
+    value) pairs, keeping the original keys."""
+    def __init__(self, equal=True):
+        self.key = self.key_equal if equal else self.key_eqv
+        self.entries = {}
+
+    def __str__(self):
+        return '<hash-table>'
+
+    @staticmethod
+    def key_eqv(x):
+        """Numbers by value and exactness, others by identity."""
+        if isinstance(x, SNumber):
+            return x.__class__, x
+        if x.__class__ == SPair or isinstance(x, SString):
+            return id(x)  # their __eq__ compares contents
+        return x
+
+    @staticmethod
+    def key_equal(x):
+        """Strings by contents, pairs and vectors by is_equal and
+        equal_hash."""
+        if x.__class__ == SPair or x.__class__ == SVector or isinstance(x, SNumVector):
+            return _EqualKey(x)
+        if isinstance(x, SString):
+            return x
+        return SHashTable.key_eqv(x)
+
+
+class _EqualKey:
+    __slots__ = ('obj', 'hash')
+
+    def __init__(self, obj):
+        self.obj = obj
+        self.hash = equal_hash(obj)
+
+    def __hash__(self):
+        return self.hash
+
+    def __eq__(self, other):
+        return other.__class__ == _EqualKey and is_equal(self.obj, other.obj)
+
+
+class SEofObject(SObject):
+    def __str__(self):
+        return '#<eof>'
+
+    def __reduce__(self):
+        return 'theEof'
+
+
+theTrue, theFalse, theNil, theEof = STrue(), SFalse(), SNil(), SEofObject()
 
 
 # special forms
 
 class SExpApplication(SExp):
-    def __init__(self, exp):
+    def __init__(self, exp, scope=None):
         operator, *operands = exp
-        self.operator = analyze(operator)
-        self.operands = tuple(map(analyze, operands))
+        self.operator = analyze(operator, scope)
+        self.operands = tuple(analyze(i, scope) for i in operands)
 
-    def __call__(self, env, evaluator, req=None):
+    def compile(self, code, tail=False):
         """The apply."""
-        if req is None:
-            return EvalRequest((self.operator,) + self.operands, env)
+        call = TAIL_CALL if tail else CALL
+        if (tail and not code.lets and isinstance(self.operator, SVariable) and
+                self.operator.name == code.name):
+            # probably calling the procedure being compiled, the evaluator
+            # checks that before reusing the frame
+            call = SELF_TAIL_CALL
+        if self.operator.__class__ == SGlobalRef and all(i.simple for i in self.operands):
+            # like (+ n 1), no need to go through the stack
+            code.emit(CALL_SIMPLE, (self.operator, tuple(i.instruction() for i in self.operands),
+                                    call))
         else:
-            proc, *operands = req.get_all()
+            code.compile(self.operator)
+            for i in self.operands:
+                code.compile(i)
+            code.emit(call, len(self.operands))
+        code.emit_return(tail)  # reached if callee isn't compound procedure
 
-            try:
-                return proc.apply(operands, env, evaluator)
-            except AttributeError:
-                raise SchemeError('Unknown procedure type (%s)' % str(proc), 'APPLY')
+    def optimize(self, optimizer):
+        self.operator = self.operator.optimize(optimizer)
+        self.operands = tuple(i.optimize(optimizer) for i in self.operands)
+        return optimizer.fold(self)
 
 
 class SExpCallCc(SExp):
@@ -141,157 +749,536 @@ class SExpCallCc(SExp):
                 raise SchemeError('Too many argument for continuation')
             raise ContinuationInvoked(self.snapshot, operands[0] if operands else theNil)
 
-    def __init__(self, exp):
+    def __init__(self, exp, scope=None):
         if len(exp) != 2:
             raise SchemeError('call/cc take exactly one argument')
-        self.arg = analyze(exp[1])
+        self.arg = analyze(exp[1], scope)
+
+    def optimize(self, optimizer):
+        self.arg = self.arg.optimize(optimizer)
+        return self
+
+    def compile(self, code, tail=False):
+        code.compile(self.arg)
+        code.emit(CAPTURE)
+        code.emit(TAIL_CALL if tail else CALL, 1)
+        code.emit_return(tail)
 
-    def __call__(self, env, evaluator, *__):
-        try:
-            return self.arg(env).apply([SExpCallCc.SContinuation(evaluator.take_snapshot())], env)
-        except AttributeError:
-            raise SchemeError('call/cc should take a procedure')
+
+class SExpCallEc(SExp):
+    """call/ec, whose continuation can only be used to escape from inside
+    the call. Capturing and invoking it copies nothing."""
+    class SEscape(SProc):
+        def __init__(self, resume):
+            # (frames, instructions, pc, env, stack, height) to go back to
+            self.resume = resume
+            self.live = True  # until the call returns or is escaped from
+
+        def __str__(self):
+            return '<escape-continuation>'
+
+        def apply(self, operands, *__):
+            return TailCall(self, operands)  # the evaluator does the jump
+
+    def __init__(self, exp, scope=None):
+        if len(exp) != 2:
+            raise SchemeError('call/ec take exactly one argument')
+        self.arg = analyze(exp[1], scope)
+
+    def optimize(self, optimizer):
+        self.arg = self.arg.optimize(optimizer)
+        return self
+
+    def compile(self, code, tail=False):
+        code.compile(self.arg)
+        code.emit(ESCAPE)
+        # never a tail call, the extent ends when ESCAPE_END is reached
+        code.emit(CALL, 1)
+        code.emit(ESCAPE_END)
+        code.emit_return(tail)
 
 
 class SExpIf(SExp):
-    def __init__(self, exp):
+    def __init__(self, exp, scope=None):
         if not 3 <= len(exp) <= 4:
             raise SchemeError('Malformed if')
         pre, con, *alter = exp[1:]
-        self.predicate, self.consequent = analyze(pre), analyze(con)
-        self.alternative = analyze(alter[0]) if alter else theFalse
-
-    def __call__(self, env, __, req=None):
-        if req is None:
-            return EvalRequest(self.predicate, env)
-        else:
-            return EvalRequest(self.consequent if is_true(req.get()) else self.alternative,
-                               env, as_value=True)
+        self.predicate, self.consequent = analyze(pre, scope), analyze(con, scope)
+        self.alternative = analyze(alter[0], scope) if alter else theFalse
+
+    def compile(self, code, tail=False):
+        code.compile(self.predicate)
+        to_alternative = code.emit(JUMP_IF_FALSE)
+        code.compile(self.consequent, tail)
+        if not tail:  # otherwise consequent has returned
+            to_end = code.emit(JUMP)
+        code.patch(to_alternative)
+        code.compile(self.alternative, tail)
+        if not tail:
+            code.patch(to_end)
+
+    def optimize(self, optimizer):
+        self.predicate = self.predicate.optimize(optimizer)
+        self.consequent = self.consequent.optimize(optimizer)
+        self.alternative = self.alternative.optimize(optimizer)
+        known = optimizer.constant(self.predicate)
+        if known is None:
+            return self
+        value, guards = known
+        if self.predicate.__class__ == SExpGuarded:
+            self.predicate = self.predicate.fallback  # checked by the same guards
+        return optimizer.guarded(self.consequent if is_true(value) else self.alternative,
+                                 self, guards)
 
 
 class SExpBegin(SExp):
-    def __init__(self, exp):
+    def __init__(self, exp, scope=None):
         if len(exp) < 2:
             raise SchemeError('Malformed begin')
-        self.body = tuple(map(analyze, exp[1:]))
+        self.body = tuple(analyze(i, scope) for i in exp[1:])
+
+    def compile(self, code, tail=False):
+        code.compile_body(self.body, tail)
 
-    def __call__(self, env, *__):
-        return EvalRequest(self.body, env, as_value=True)
+    def optimize(self, optimizer):
+        self.body = optimizer.sequence(self.body)
+        return self.body[0] if len(self.body) == 1 else self
 
 
 class SExpAssignment(SExp):
-    def __init__(self, exp):
+    def __init__(self, exp, scope=None):
         if len(exp) != 3 or exp[1].__class__ != str:
             raise SchemeError('Malformed assignment')
-        self.variable, self.value = exp[1], analyze(exp[2])
+        self.variable, self.value = exp[1], analyze(exp[2], scope)
+        self.target = make_variable(self.variable, scope)
 
-    def __call__(self, env, __, req=None):
-        if req is None:
-            return EvalRequest(self.value, env)
-        else:
-            env.set_var_value(self.variable, req.get())
-        return theNil
+    def compile(self, code, tail=False):
+        code.compile(self.value)
+        code.emit(SET, self.target)
+        code.emit_return(tail)
+
+    def optimize(self, optimizer):
+        self.value = self.value.optimize(optimizer)
+        return self
 
 
 class SExpDefinition(SExp):
-    def __init__(self, exp):
+    def __init__(self, exp, scope=None):
         try:
+            self.variable = self.defined_name(exp)
+            if scope is not None:  # usually declared already by SExpLambda
+                scope.declare(self.variable)
+            self.target = make_variable(self.variable, scope)
             if isinstance(exp[1], str):
                 var, value = exp[1:]
-                self.variable, self.value = var, analyze(value)
+                if isinstance(value, tuple) and value and value[0] == 'lambda':
+                    self.value = SExpLambda(value, scope, self.variable)
+                else:
+                    self.value = analyze(value, scope)
             else:  # define function
                 if not exp[2:]:
                     raise SchemeError('Malformed define')
                 lambda_exp = ('lambda', exp[1][1:]) + exp[2:]
-                self.variable, self.value = exp[1][0], SExpLambda(lambda_exp)
-        except (IndexError, ValueError):
+                self.value = SExpLambda(lambda_exp, scope, self.variable)
+        except (IndexError, ValueError, TypeError):
             raise SchemeError('Malformed define')
 
-    def __call__(self, env, __, req=None):
-        if req is None:
-            return EvalRequest(self.value, env)
-        else:
-            value = req.get()
-            if value.__class__ == SCompoundProc and value.name is None:
-                value.name = self.variable
-            env.def_var(self.variable, value)
-        return theNil
+    def compile(self, code, tail=False):
+        code.compile(self.value)
+        code.emit(DEFINE, self.target)
+        code.emit_return(tail)
+
+    def optimize(self, optimizer):
+        self.value = self.value.optimize(optimizer)
+        return self
+
+    @staticmethod
+    def defined_name(exp):
+        return exp[1] if isinstance(exp[1], str) else exp[1][0]
+
+
+class SExpDefineRecordType(SExp):
+    """(define-record-type <name> (constructor field...) predicate
+    (field accessor [modifier])...) defines primitive procedures of a new
+    record type. The type is made at analyze time (or when unpickled), so
+    it's the same every time the form is evaluated."""
+    def __init__(self, exp, scope=None):
+        names = self.defined_names(exp)
+        self.exp = exp
+        values = self._procedures(exp)
+        if scope is not None:  # usually declared already by SExpLambda
+            for i in names:
+                scope.declare(i)
+        self.definitions = tuple((make_variable(name, scope), value)
+                                 for name, value in zip(names, values))
+
+    def __getstate__(self):
+        # the procedures can't be pickled, they are made again from exp
+        return {'exp': self.exp, 'targets': tuple(i for i, __ in self.definitions)}
+
+    def __setstate__(self, state):
+        self.exp = state['exp']
+        self.definitions = tuple(zip(state['targets'], self._procedures(self.exp)))
+
+    def _procedures(self, exp):
+        """Make the record type, then the procedures, in the order of
+        defined_names."""
+        __, type_name, constructor, predicate, *specs = exp
+        fields = tuple(i[0] for i in specs)
+        if isinstance(constructor, str):  # takes all fields
+            constructor = (constructor,) + fields
+        if len(set(fields)) != len(fields) or not set(constructor[1:]) <= set(fields):
+            raise SchemeError('Malformed define-record-type')
+        record_type = SRecordType(type_name.strip('<>') or type_name, fields)
+        cls = record_type.cls
+        values = [record_type, self._constructor(cls, constructor[1:], constructor[0]),
+                  SPrimitiveProc(lambda operands, *__: theTrue if len(operands) == 1 and
+                                 operands[0].__class__ == cls else theFalse,
+                                 predicate, pure=True)]
+        for field, *procs in specs:
+            slot = cls.__slots__[fields.index(field)]
+            values.append(self._accessor(cls, slot, procs[0]))
+            if len(procs) == 2:
+                values.append(self._modifier(cls, slot, procs[1]))
+        return values
+
+    def compile(self, code, tail=False):
+        for i, (target, value) in enumerate(self.definitions):
+            if i:
+                code.emit(POP)
+            code.emit(CONST, value)
+            code.emit(DEFINE, target)
+        code.emit_return(tail)
+
+    @staticmethod
+    def defined_names(exp):
+        """Names in the order they are defined: the type, constructor,
+        predicate, then accessor and modifier of each field."""
+        try:
+            __, type_name, constructor, predicate, *specs = exp
+            names = [type_name, constructor if isinstance(constructor, str) else constructor[0],
+                     predicate]
+            for field, *procs in specs:
+                if not 1 <= len(procs) <= 2:
+                    raise ValueError
+                names.extend(procs)
+            if not all(isinstance(i, str) and i for i in names + list(constructor[1:])):
+                raise ValueError
+            return names
+        except (IndexError, ValueError, TypeError):
+            raise SchemeError('Malformed define-record-type')
+
+    @staticmethod
+    def _constructor(cls, args, name):
+        slots = tuple(cls.__slots__[cls.type.fields.index(i)] for i in args)
+        unset = tuple(i for i in cls.__slots__ if i not in slots)
+        n = len(slots)
+
+        def constructor(operands, *__):
+            if len(operands) != n:
+                raise SchemeError('take exactly %d argument' % n)
+            record = cls()
+            for slot, value in zip(slots, operands):
+                setattr(record, slot, value)
+            for slot in unset:
+                setattr(record, slot, theNil)
+            return record
+        return SPrimitiveProc(constructor, name, pure=True)
+
+    @staticmethod
+    def _accessor(cls, slot, name):
+        def accessor(operands, *__):
+            if len(operands) != 1 or operands[0].__class__ != cls:
+                raise SchemeError('Expected a %s' % cls.type.name)
+            return getattr(operands[0], slot)
+        return SPrimitiveProc(accessor, name, pure=True)
+
+    @staticmethod
+    def _modifier(cls, slot, name):
+        def modifier(operands, *__):
+            if len(operands) != 2 or operands[0].__class__ != cls:
+                raise SchemeError('Expected a %s and a value' % cls.type.name)
+            setattr(operands[0], slot, operands[1])
+            return theNil
+        return SPrimitiveProc(modifier, name)
 
 
 class SExpLambda(SExp):
-    def __init__(self, exp):
+    def __init__(self, exp, scope=None, name=None):
         if len(exp) < 3 or not isinstance(exp[1], tuple):
             raise SchemeError('Malformed lambda')
         param, *body = exp[1:]
-        self.parameters, self.body = param, tuple(map(analyze, body))
+        # internal definitions get slots in the frame before analyzing the
+        # body, so that they can refer to each other
+        scope = Scope(param, scope)
+        for i in self._internal_definitions(body):
+            scope.declare(i)
+        self.parameters, self.name = param, name
+        self.body = tuple(analyze(i, scope) for i in body)
+        self.frame_names = tuple(scope.names)
+        self._code = None  # compiled body
+
+    def __getstate__(self):
+        return dict(vars(self), _code=None)  # compiled again when needed
+
+    def get_code(self):
+        if self._code is None:
+            code = Code(self.name or 'lambda')
+            code.compile_body(self.body)
+            self._code = code.finish()
+        return self._code
+
+    def compile(self, code, tail=False):
+        code.emit(MAKE_CLOSURE, (self, self.get_code()))
+        code.emit_return(tail)
+
+    def optimize(self, optimizer):
+        self.body = optimizer.sequence(self.body)
+        return self
 
-    def __call__(self, env, *__):
-        return SCompoundProc(self.parameters, self.body, env)
+    @staticmethod
+    def _internal_definitions(body):
+        for exp in body:
+            if isinstance(exp, tuple) and len(exp) > 1:
+                if exp[0] == 'define' and exp[1]:
+                    yield SExpDefinition.defined_name(exp)
+                elif exp[0] == 'begin':
+                    yield from SExpLambda._internal_definitions(exp[1:])
+                elif exp[0] == 'define-record-type':
+                    yield from SExpDefineRecordType.defined_names(exp)
 
 
 class SExpQuote(SExp):
-    def __init__(self, exp):
+    simple = True
+
+    def __init__(self, exp, scope=None):
         if len(exp) != 2:
             raise SchemeError('Malformed quote')
         self.datum = self.walker(exp[1])
 
-    def __call__(self, *__):
+    def instruction(self):
+        return CONST, self.datum
+
+    def compile(self, code, tail=False):
+        code.emit(CONST, self.datum)
+        code.emit_return(tail)
+
+    def constant(self):
         return self.datum
 
     @staticmethod
     def walker(data):
-        # return a list that contains list or self-eval expressions
-        return (SPair.make_list(tuple(map(SExpQuote.walker, data)))
-                if isinstance(data, tuple) else analyze(data))
+        """Return a list that contains lists or self-eval expressions, made
+        with an explicit stack, so data can be nested deeply."""
+        if data.__class__ != tuple:
+            return make_atom(data)
+        stack = [(data, [])]  # tuples being converted, and their items so far
+        while True:
+            items, done = stack[-1]
+            if len(done) < len(items):
+                item = items[len(done)]
+                if item.__class__ == tuple:
+                    stack.append((item, []))
+                else:
+                    done.append(make_atom(item))
+                continue
+            stack.pop()
+            value = SPair.make_list(done)
+            if not stack:
+                return value
+            stack[-1][1].append(value)
 
 
 class SExpOr(SExp):
-    def __init__(self, exp):
-        self.seq = tuple(map(analyze, exp[1:]))
-
-    def __call__(self, env, __, req=None):
-        if req is None:
-            return EvalRequest(self.seq[0], env, our_idx=0) if self.seq else theFalse
-        else:
-            value, next_idx = req.get(), req.our_idx + 1
-            if is_true(value):
-                return value
-            elif next_idx < len(self.seq):
-                return EvalRequest(self.seq[next_idx], env, our_idx=next_idx)
-            else:  # all exp are false, return the value of the last
-                return value
+    def __init__(self, exp, scope=None):
+        self.seq = tuple(analyze(i, scope) for i in exp[1:])
+
+    def compile(self, code, tail=False):
+        if not self.seq:
+            code.emit(CONST, theFalse)
+            code.emit_return(tail)
+            return
+        jumps = []
+        for exp in self.seq[:-1]:
+            code.compile(exp)
+            jumps.append(code.emit(JUMP_IF_TRUE_OR_POP))
+        code.compile(self.seq[-1], tail)  # the last one is in tail position
+        for i in jumps:
+            code.patch(i)
+        if jumps:
+            code.emit_return(tail)
+
+    def optimize(self, optimizer):
+        self.seq = tuple(i.optimize(optimizer) for i in self.seq)
+        return self
 
 
 class SExpAnd(SExp):
-    def __init__(self, exp):
-        self.seq = tuple(map(analyze, exp[1:]))
+    def __init__(self, exp, scope=None):
+        self.seq = tuple(analyze(i, scope) for i in exp[1:])
+
+    def compile(self, code, tail=False):
+        if not self.seq:
+            code.emit(CONST, theTrue)
+            code.emit_return(tail)
+            return
+        jumps = []
+        for exp in self.seq[:-1]:
+            code.compile(exp)
+            jumps.append(code.emit(JUMP_IF_FALSE_OR_POP))
+        code.compile(self.seq[-1], tail)  # the last one is in tail position
+        for i in jumps:
+            code.patch(i)
+        if jumps:
+            code.emit_return(tail)
+
+    def optimize(self, optimizer):
+        self.seq = tuple(i.optimize(optimizer) for i in self.seq)
+        return self
+
 
-    def __call__(self, env, __, req=None):
-        if req is None:
-            return EvalRequest(self.seq[0], env, our_idx=0) if self.seq else theTrue
+class SExpLet(SExp):
+    """The body is evaluated in a new frame holding the values of the
+    bindings, so no procedure is made or called."""
+    def __new__(cls, exp=(), scope=None):  # no arguments when unpickled
+        if len(exp) > 1 and isinstance(exp[1], str):
+            return SExpNamedLet(exp, scope)
+        return super().__new__(cls)
+
+    def __init__(self, exp, scope=None):
+        if len(exp) < 3:
+            raise SchemeError('Malformed let')
+        bindings, *body = exp[1:]
+        names, inits = self.split_bindings(bindings, 'let')
+        self.inits = tuple(analyze(i, scope) for i in inits)
+        # internal definitions get slots after the bindings, like in lambda
+        scope = Scope(names, scope)
+        for i in SExpLambda._internal_definitions(body):
+            scope.declare(i)
+        self.body = tuple(analyze(i, scope) for i in body)
+        self.frame_names = tuple(scope.names)
+        self.padding = (unassigned,) * (len(self.frame_names) - len(names))
+
+    def compile(self, code, tail=False):
+        for i in self.inits:
+            code.compile(i)
+        code.emit(ENTER, (self.frame_names, len(self.inits), self.padding))
+        code.lets += 1
+        code.compile_body(self.body, tail)
+        code.lets -= 1
+        if not tail:  # else the frame is left by returning
+            code.emit(LEAVE)
+
+    def optimize(self, optimizer):
+        self.inits = tuple(i.optimize(optimizer) for i in self.inits)
+        self.body = optimizer.sequence(self.body)
+        return self
+
+    @staticmethod
+    def split_bindings(bindings, form):
+        """Return names and inits of bindings ((name init) ...)."""
+        if not isinstance(bindings, tuple) or not all(
+                isinstance(i, tuple) and len(i) == 2 and isinstance(i[0], str)
+                for i in bindings):
+            raise SchemeError('Malformed %s' % form)
+        return tuple(i[0] for i in bindings), tuple(i[1] for i in bindings)
+
+
+class SExpDo(SExp):
+    """(do ((var init step)...) (test expr...) command...), a loop in a
+    frame like that of let. Each iteration gets new bindings of the vars,
+    but the frame is reused if nothing refers to the previous one."""
+    def __init__(self, exp, scope=None):
+        if len(exp) < 3 or not isinstance(exp[1], tuple) or not isinstance(exp[2], tuple) or \
+                not exp[2] or not all(isinstance(i, tuple) and len(i) in (2, 3) and
+                                      isinstance(i[0], str) for i in exp[1]):
+            raise SchemeError('Malformed do')
+        specs, (test, *exprs), *commands = exp[1:]
+        names = tuple(i[0] for i in specs)
+        self.inits = tuple(analyze(i[1], scope) for i in specs)
+        scope = Scope(names, scope)
+        self.test = analyze(test, scope)
+        self.exprs = tuple(analyze(i, scope) for i in exprs)
+        self.commands = tuple(analyze(i, scope) for i in commands)
+        # a var without step keeps its value
+        self.steps = tuple(analyze(i[2] if len(i) == 3 else i[0], scope) for i in specs)
+        if len(scope.names) != len(names):
+            raise SchemeError('Definition in do')
+        self.frame_names = names
+
+    def compile(self, code, tail=False):
+        for i in self.inits:
+            code.compile(i)
+        code.emit(ENTER, (self.frame_names, len(self.inits), ()))
+        code.lets += 1
+        loop = len(code.instructions)
+        code.compile(self.test)
+        to_commands = code.emit(JUMP_IF_FALSE)
+        if self.exprs:
+            code.compile_body(self.exprs, tail)
         else:
-            value, next_idx = req.get(), req.our_idx + 1
-            if is_false(value):
-                return value
-            elif next_idx < len(self.seq):
-                return EvalRequest(self.seq[next_idx], env, our_idx=next_idx)
-            else:  # all exp are true, return the value of the last
-                return value
+            code.emit(CONST, theNil)
+            code.emit_return(tail)
+        if not tail:
+            code.emit(LEAVE)
+            to_end = code.emit(JUMP)
+        code.patch(to_commands)
+        for i in self.commands:
+            code.compile(i)
+            code.emit(POP)
+        for i in self.steps:
+            code.compile(i)
+        code.emit(NEXT, len(self.steps))
+        code.emit(JUMP, loop)
+        code.lets -= 1
+        if not tail:
+            code.patch(to_end)
+
+    def optimize(self, optimizer):
+        self.inits = tuple(i.optimize(optimizer) for i in self.inits)
+        self.test = self.test.optimize(optimizer)
+        if self.exprs:
+            self.exprs = optimizer.sequence(self.exprs)
+        self.commands = tuple(i.optimize(optimizer) for i in self.commands)
+        self.steps = tuple(i.optimize(optimizer) for i in self.steps)
+        return self
 
 
 # derived expressions
 # And and Or can be derived (using If)
+# tail position of derived ones is taken care of by the expressions they
+# are converted to
+
+class SExpWhen(SExp):
+    """(when test body...), or unless if the test is negated."""
+    def __init__(self, exp, scope=None):
+        if len(exp) < 3:
+            raise SchemeError('Malformed %s' % exp[0])
+        test, *body = exp[1:]
+        body = ('begin',) + tuple(body)
+        self.body = analyze(('if', test, body) if exp[0] == 'when' else
+                            ('if', test, '#f', body), scope)
+
+    def compile(self, code, tail=False):
+        code.compile(self.body, tail)
+
+    def optimize(self, optimizer):
+        return self.body.optimize(optimizer)
+
 
 class SExpCond(SExp):
-    def __init__(self, exp):
+    def __init__(self, exp, scope=None):
         try:
             clauses = exp[1:]
-            self.body = analyze(self._expand_clauses(clauses))
+            self.body = analyze(self._expand_clauses(clauses), scope)
         except IndexError:
             raise SchemeError('Malformed cond')
 
-    def __call__(self, env, *__):
-        return EvalRequest(self.body, env, as_value=True)
+    def compile(self, code, tail=False):
+        code.compile(self.body, tail)
+
+    def optimize(self, optimizer):
+        return self.body.optimize(optimizer)
 
     @staticmethod
     def _expand_clauses(clauses):
@@ -318,33 +1305,78 @@ class SExpCond(SExp):
         return ('if', first_predicate, seq_to_exp(first_acts), SExpCond._expand_clauses(rest))
 
 
-class SExpLet(SExp):
-    def __init__(self, exp):
-        try:
-            bounds, *body = exp[1:]
-            self.app = analyze(self._to_combination(bounds, tuple(body)))
-        except (IndexError, ValueError):
+class SExpLetStar(SExp):
+    """let*, as nested lets."""
+    def __init__(self, exp, scope=None):
+        if len(exp) < 3:
+            raise SchemeError('Malformed let*')
+        bindings, *body = exp[1:]
+        SExpLet.split_bindings(bindings, 'let*')
+        exp = ('let', bindings[-1:]) + tuple(body)
+        for i in reversed(bindings[:-1]):
+            exp = ('let', (i,), exp)
+        self.body = analyze(exp, scope)
+
+    def compile(self, code, tail=False):
+        code.compile(self.body, tail)
+
+    def optimize(self, optimizer):
+        return self.body.optimize(optimizer)
+
+
+class SExpLetrec(SExp):
+    """letrec and letrec*, as a let whose body defines the variables."""
+    def __init__(self, exp, scope=None):
+        if len(exp) < 3:
+            raise SchemeError('Malformed %s' % exp[0])
+        bindings, *body = exp[1:]
+        names, inits = SExpLet.split_bindings(bindings, exp[0])
+        definitions = tuple(('define', name, init) for name, init in zip(names, inits))
+        self.body = analyze(('let', ()) + definitions + tuple(body), scope)
+
+    def compile(self, code, tail=False):
+        code.compile(self.body, tail)
+
+    def optimize(self, optimizer):
+        return self.body.optimize(optimizer)
+
+
+class SExpNamedLet(SExp):
+    """(let name bindings body...), as an application of a procedure bound
+    by letrec, so calling name in tail position reuses the frame."""
+    def __init__(self, exp, scope=None):
+        if len(exp) < 4:
             raise SchemeError('Malformed let')
+        name, bindings, *body = exp[1:]
+        names, inits = SExpLet.split_bindings(bindings, 'let')
+        lambda_exp = ('lambda', names) + tuple(body)
+        self.app = analyze((('letrec', ((name, lambda_exp),), name),) + inits, scope)
 
-    def __call__(self, env, *__):
-        return EvalRequest(self.app, env, as_value=True)
+    def compile(self, code, tail=False):
+        code.compile(self.app, tail)
 
-    @staticmethod
-    def _to_combination(bounds, body):
-        lambda_exp = ('lambda', tuple(map(lambda x: x[0], bounds))) + body
-        app_exp = (lambda_exp,) + tuple(map(lambda x: x[1], bounds))
-        return app_exp
+    def optimize(self, optimizer):
+        return self.app.optimize(optimizer)
 
 
 _special_forms = {
     'call/cc': SExpCallCc,
     'call-with-current-continuation': SExpCallCc,
+    'call/ec': SExpCallEc,
+    'call-with-escape-continuation': SExpCallEc,
     'if': SExpIf,
     'define': SExpDefinition,
+    'define-record-type': SExpDefineRecordType,
     'set!': SExpAssignment,
     'begin': SExpBegin,
     'cond': SExpCond,
+    'when': SExpWhen,
+    'unless': SExpWhen,
     'let': SExpLet,
+    'let*': SExpLetStar,
+    'letrec': SExpLetrec,
+    'letrec*': SExpLetrec,
+    'do': SExpDo,
     'lambda': SExpLambda,
     'quote': SExpQuote,
     'and': SExpAnd,
@@ -357,23 +1389,128 @@ _int_exp = re.compile(r'^[-+]?[0-9]*$')
 _str_exp = re.compile(r'^".*"$')
 
 
-def analyze(exp):
+def make_variable(name, scope):
+    """Variables outside any lambda are looked up by name at runtime."""
+    return SGlobalRef(name) if scope is None else scope.resolve(name)
+
+
+def make_atom(exp):
+    """Turn raw atom into number, string or symbol."""
+    try:
+        return SNumber(exp)
+    except ValueError:
+        pass
+    return SString(exp) if _str_exp.match(exp) else SSymbol(exp)
+
+
+def analyze(exp, scope=None):
     """This procedure make syntax analyzing and turn raw expression into
-    SExp instance."""
+    SExp instance. scope is the Scope of the innermost lambda that exp is
+    in, or None if exp is at top level."""
     if isinstance(exp, str) and exp:
-        try:
-            return SNumber(exp)
-        except ValueError:
-            pass
-        if _str_exp.match(exp):
-            return SString(exp)
-        else:
-            return SSymbol(exp)  # treat symbols as variables
+        atom = make_atom(exp)
+        if atom.__class__ == SSymbol:  # treat symbols as variables
+            return make_variable(exp, scope)
+        return atom
     elif isinstance(exp, tuple) and exp:
         name = exp[0]
         if name in _special_forms:
-            return _special_forms[name](exp)
+            return _special_forms[name](exp, scope)
         else:
             # exp can only be application
-            return SExpApplication(exp)
+            return SExpApplication(exp, scope)
     raise SchemeError('Unknown expression type (%s)' % str(exp), 'ANALYZE')
+
+
+# optimization
+
+class SExpGuarded(SExp):
+    """Made by Optimizer: exp is evaluated in place of fallback, as long as
+    the global variables in guards keep the values exp was made with."""
+    def __init__(self, exp, fallback, guards):
+        self.exp, self.fallback = exp, fallback
+        self.guards = guards  # tuple of (SGlobalRef, value)
+
+    def compile(self, code, tail=False):
+        guard = code.emit(GUARD)
+        code.compile(self.exp, tail)
+        if not tail:
+            to_end = code.emit(JUMP)
+        code.instructions[guard] = (GUARD, (self.guards, len(code.instructions)))
+        code.compile(self.fallback, tail)
+        if not tail:
+            code.patch(to_end)
+
+    def constant(self):
+        return self.exp.constant()
+
+    def nodes(self):
+        return self.exp.nodes()  # the fallback is normally not evaluated
+
+
+class Optimizer:
+    """Constant folding and dead code elimination of analyzed expressions,
+    which is done by SExp.optimize with the help of this. Applications of
+    pure primitives on constants are evaluated, taking primitives from the
+    global variables of env, and if expressions whose predicate is known
+    are replaced by a branch. The results are SExpGuarded, so rebinding a
+    primitive makes them fall back on the original expression."""
+    def __init__(self, env):
+        self.env = env
+        self.removed = 0  # number of expressions removed
+
+    def __call__(self, exp):
+        nodes = exp.nodes()
+        exp = exp.optimize(self)
+        self.removed += nodes - exp.nodes()
+        return exp
+
+    def _global(self, ref):
+        try:
+            return self.env.get_cell(ref.name).value
+        except SchemeError:
+            return None
+
+    def constant(self, exp):
+        """Return (value, guards) if the value of exp is known, else None."""
+        value = exp.constant()
+        if value is not None:
+            return value, exp.guards if exp.__class__ == SExpGuarded else ()
+        if exp.__class__ == SGlobalRef:  # like #t
+            value = self._global(exp)
+            if isinstance(value, SBool):
+                return value, ((exp, value),)
+        return None
+
+    def guarded(self, exp, fallback, guards):
+        return SExpGuarded(exp, fallback, guards) if guards else exp
+
+    def fold(self, app):
+        """Evaluate app now if possible."""
+        if app.operator.__class__ != SGlobalRef:
+            return app
+        proc = self._global(app.operator)
+        if proc.__class__ != SPrimitiveProc or not proc.pure:
+            return app
+        operands = tuple(map(self.constant, app.operands))
+        if None in operands:
+            return app
+        try:
+            value = proc.apply([i for i, __ in operands], self.env, None)
+        except SchemeError:
+            return app  # leave the error to runtime
+        if not isinstance(value, SSelfEvalExp):
+            return app  # such as a new pair, which must not be shared
+        guards = sum((i for __, i in operands), ((app.operator, proc),))
+        return self.guarded(value, app, tuple(dict.fromkeys(guards)))
+
+    def sequence(self, body):
+        """Optimize a body, splicing begin and dropping constants whose
+        value is unused."""
+        result = []
+        for exp in body:
+            exp = exp.optimize(self)
+            result.extend(exp.body if exp.__class__ == SExpBegin else (exp,))
+        last = result.pop()
+        return tuple(i for i in result if i.constant() is None or
+                     i.__class__ == SExpGuarded) + (last,)
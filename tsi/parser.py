@@ -1,51 +1,209 @@
 import re
-from collections import deque
+from operator import length_hint
 from . import SchemeError
 
-# left parenthesis | right parenthesis | string like "www www" | quote | symbol
-_tokenize = re.compile(r'''\(|\)|"[^"]*"|'|[^\(\)\s"]+''')
+# blanks and comments, then left parenthesis | right parenthesis | string
+# like "www www" | quote | symbol, or a lone " (an unterminated string), or
+# '' at the end
+_token = re.compile(r'''(?:\s+|;[^\n]*)*(\(|\)|"[^"]*"|'|[^()\s";]+|"|\Z)''')
+_delimiters = frozenset(('(', ')', "'", '"', ''))  # tokens that aren't atoms
 
 
 class IncompleteInputError(SchemeError):
     pass
 
 
+class Reader:
+    """Reads expressions from src one at a time without recursion. Atoms are
+    strings and lists are tuples of them. Tokens are found a batch of lines
+    at a time, and the position of the last expression read is kept (see
+    position), from which those of data inside it are found (see locate)."""
+    batch_size = 1 << 16  # characters
+
+    def __init__(self, src, read_block=None):
+        """If read_block is given, src is followed by the text it returns,
+        until it returns ''."""
+        self.src = src
+        self._read_block = read_block
+        self._base, self._lines = 0, 0  # characters and lines dropped from src
+        self._batches = self._tokenize()
+        self._batch, self._batch_pos, self._tokens = [], 0, iter(())
+        self._start = (0, 0)  # batch offset and index of the last expression
+
+    def __iter__(self):
+        return iter(self.read, None)
+
+    def _tokenize(self):
+        """Yield offset of a batch of tokens and the tokens. Batches end at a
+        newline, where no token but a string can go on."""
+        pos, size = 0, self.batch_size
+        while True:
+            src, start = self.src, pos - self._base
+            end = src.find('\n', start + size)
+            if end == -1:
+                if self._more():
+                    continue
+                yield pos, _token.findall(src, start)
+                return
+            tokens = _token.findall(src, start, end)
+            if '"' in tokens:  # a string goes on after end
+                size *= 2
+                continue
+            while tokens and not tokens[-1]:
+                tokens.pop()
+            yield pos, tokens
+            pos, size = self._base + end, self.batch_size
+
+    def _more(self):
+        """Read a block into src, return False at the end. Text before the
+        batch of the last expression is dropped, it won't be needed."""
+        block = self._read_block and self._read_block()
+        if not block:
+            self._read_block = None
+            return False
+        cut = self._start[0] - self._base
+        self._lines += self.src.count('\n', 0, cut)
+        self.src = self.src[cut:] + block
+        self._base += cut
+        return True
+
+    def position(self, start=None):
+        """Return (line, column) of the last expression read (or the token
+        at start), counted from 1. See locate for data inside it."""
+        return self._line_column(next(self._tokens_from(start or self._start))[1])
+
+    def locate(self, path):
+        """Return (line, column) of a datum inside the last expression read,
+        at path: indexes of list items leading to it, e.g. (1, 0) for b in
+        (a (b c)), and (1,) for x in 'x, which is (quote x). Positions aren't
+        kept while reading, the tokens of the expression are scanned again."""
+        tokens = self._tokens_from(self._start)
+        token, offset = next(tokens)
+        for i in path:
+            if token == "'" and i in (0, 1):
+                if i:
+                    token, offset = next(tokens)
+                continue
+            if token != '(':
+                raise IndexError('No datum at %s' % (path,))
+            token, offset = next(tokens)
+            for __ in range(i):
+                if token == ')':
+                    break
+                depth = 0
+                while True:  # skip a datum
+                    depth += (token == '(') - (token == ')')
+                    if not depth and token != "'":
+                        break
+                    token, offset = next(tokens)
+                token, offset = next(tokens)
+            if token == ')':
+                raise IndexError('No datum at %s' % (path,))
+        return self._line_column(offset)
+
+    def _tokens_from(self, start):
+        """Yield tokens and their offsets in src, from the token at start."""
+        pos, index = start
+        for m in _token.finditer(self.src, pos - self._base):
+            if index:
+                index -= 1
+            else:
+                yield m.group(1), m.start(1)
+
+    def _line_column(self, offset):
+        # src starts at a newline once text is dropped
+        line = self._lines + self.src.count('\n', 0, offset) + 1
+        return line, offset - self.src.rfind('\n', 0, offset)
+
+    def error(self, cls, msg, start):
+        return cls('%s (line %d, column %d)' % ((msg,) + self.position(start)))
+
+    def read(self):
+        """Return the next expression, or None if there's nothing left."""
+        stack = []  # lists of the unfinished levels, and "'" for pending quotes
+        top = None  # stack[-1]
+        while True:
+            for token in self._tokens:
+                if token not in _delimiters:  # an atom
+                    if top.__class__ == list:
+                        top.append(token)
+                        continue
+                    if top is None:
+                        self._start = self._index()
+                        return token
+                    exp = token
+                elif token == '(' or token == "'":
+                    if top is None:
+                        self._start = self._index()
+                    top = [] if token == '(' else token
+                    stack.append(top)
+                    continue
+                elif token == ')':
+                    if top.__class__ != list:
+                        raise self.error(SchemeError, 'Too many right parentheses' if top is None
+                                         else "Parenthesis doesn't match", self._index())
+                    exp = tuple(stack.pop())
+                elif token:
+                    raise self.error(IncompleteInputError, 'Unterminated string', self._index())
+                elif stack:
+                    raise self.error(IncompleteInputError, 'Too few right parentheses',
+                                     self._start)
+                else:
+                    return None  # the end
+                while stack and stack[-1] == "'":
+                    stack.pop()
+                    exp = ('quote', exp)
+                if not stack:
+                    return exp
+                top = stack[-1]
+                top.append(exp)
+            try:
+                self._batch_pos, self._batch = next(self._batches)
+            except StopIteration:
+                return None
+            self._tokens = iter(self._batch)
+
+    def _index(self):
+        """Batch offset and index of the token just read."""
+        return self._batch_pos, len(self._batch) - length_hint(self._tokens) - 1
+
+
 def parse(src):
     """Parse a string that contains scheme expression and return a tuple of
     atoms (string or tuple of atoms). Examples:
         (define aa 1) => (('define', 'aa', '1'),)
         'a 'b => (('quote', 'a'), ('quote', 'b'))"""
-    # taken from lis.py, my old solution has been completely beaten by this...
-    def read_from_tokens():
-        """If tokens starts with left parenthesis, return all tokens (recursively
-        apply this function) in matched parenthesis. Else, return the first token."""
-        token = tokens.popleft()
-        if token == '(':
-            lv = deque()  # tokens from current level (depth)
-            while tokens[0] != ')':
-                lv.append(read_from_tokens())
-            assert tokens.popleft() == ')'
-            return tuple(lv)
-        elif token == ')':
-            raise SchemeError("Parenthesis doesn't match")
-        elif token == "'":
-            return ('quote', read_from_tokens())
-        else:
-            return token
-
     if not src:
         raise IncompleteInputError('Nothing to parse')
-    src = ''.join(map(lambda l: l.partition(';')[0], src.split('\n')))
-    src = '(%s)' % src  # add a virtual root
-    tokens = deque(_tokenize.findall(src))
+    return tuple(Reader(src))
+
 
-    try:
-        ret = read_from_tokens()
-    except IndexError:
-        raise IncompleteInputError('Too few right parentheses')
-    if tokens:
-        raise SchemeError('Too many right parentheses')
-    return ret
+def read_datum(next_token):
+    """Read one expression from tokens got by calling next_token (which
+    returns None at the end), taking no more tokens than needed. Return it
+    like parse does, or None if there are no tokens left."""
+    stack = []  # lists of the unfinished levels, and "'" for pending quotes
+    while True:
+        token = next_token()
+        if token is None:
+            if stack:
+                raise IncompleteInputError('Too few right parentheses')
+            return None
+        if token == '(' or token == "'":
+            stack.append([] if token == '(' else token)
+            continue
+        if token == ')':
+            if not stack or stack[-1] == "'":
+                raise SchemeError("Parenthesis doesn't match")
+            exp = tuple(stack.pop())
+        else:
+            exp = token
+        while stack and stack[-1] == "'":
+            stack.pop()
+            exp = ('quote', exp)
+        if not stack:
+            return exp
+        stack[-1].append(exp)
 
 
 def parse_input():
@@ -57,6 +215,8 @@ def parse_input():
             ret = parse(s)
             if len(ret) > 1:
                 raise SchemeError('Multiple expressions on a line')
-            return ret[0]
+            if ret:
+                return ret[0]
         except IncompleteInputError:
-            s += ' ' + input()
+            pass
+        s += '\n' + input()
@@ -1,9 +1,11 @@
 """Implementation of primitive procedures."""
+import math
+import operator
 import sys
 from functools import reduce
-from . import SPrimitiveProc, EvalRequest, SchemeError
+from itertools import product
+from . import SProc, SPrimitiveProc, SCompoundProc, TailCall, SchemeError, cache
 from .expression import *
-from .parser import parse, parse_input
 
 
 def check_len_eq(operands, num):
@@ -16,6 +18,11 @@ def check_len_gt(operands, num):
         raise SchemeError('Too few arguments')
 
 
+def check_len_in(operands, low, high):
+    if not low <= len(operands) <= high:
+        raise SchemeError('take %d to %d arguments' % (low, high))
+
+
 def extract_instance(operands, t):
     if len(operands) != 1 or not isinstance(operands[0], t):
         raise SchemeError('Expected a %s' % t.__name__[1:])
@@ -60,14 +67,42 @@ def _prim_modulo(operands, *__):
     return SNumber(operands[0] % operands[1])
 
 
-def _prim_display(operands, *__):
-    check_len_eq(operands, 1)
-    # avoid message not showing when using print(o, end='')
-    sys.stdout.write(str(operands[0]))
-    sys.stdout.flush()
+def _output_port(operands, n, evaluator):
+    """The port given as the optional operand after n ones, or the current
+    output port of evaluator."""
+    check_len_in(operands, n, n + 1)
+    if len(operands) == n:
+        return evaluator.output
+    if not isinstance(operands[n], SOutputPort):
+        raise SchemeError('Expected a OutputPort')
+    return operands[n]
+
+
+def _prim_display(operands, __, evaluator):
+    port = _output_port(operands, 1, evaluator)
+    write(operands[0], port)
+    return theNil
+
+
+def _prim_newline(operands, __, evaluator):
+    _output_port(operands, 0, evaluator).write('\n')
+    return theNil
+
+
+def _prim_print(operands, __, evaluator):
+    evaluator.output.write(' '.join(map(str, operands)) + '\n')
     return theNil
 
 
+def _prim_flush_output(operands, __, evaluator):
+    _output_port(operands, 0, evaluator).flush()
+    return theNil
+
+
+def _prim_get_output_string(operands, *__):
+    return SString(extract_instance(operands, SStringOutputPort).getvalue())
+
+
 def _prim_not(operands, *__):
     check_len_eq(operands, 1)
     return theFalse if is_true(operands[0]) else theTrue
@@ -82,12 +117,16 @@ def _gen_prim_cmp(cmp):
                 return theFalse
         return theTrue
 
-    return SPrimitiveProc(template)
+    return SPrimitiveProc(template, pure=True)
 
 
-def _prim_eq(operands, *__):
-    check_len_eq(operands, 2)
-    return theTrue if operands[0] == operands[1] else theFalse
+def _gen_prim_same(same):
+    """Used to generate eq?, eqv? and equal?"""
+    def template(operands, *__):
+        check_len_eq(operands, 2)
+        return theTrue if same(*operands) else theFalse
+
+    return SPrimitiveProc(template, pure=True)
 
 
 def _prim_cons(operands, *__):
@@ -96,12 +135,12 @@ def _prim_cons(operands, *__):
 
 
 def _gen_pair_dr(part):
-    """Used to generate shortcuts like cadr."""
+    """Used to generate car and cdr."""
     def template(operands, *__):
         pair = extract_instance(operands, SPair)
         return getattr(pair, part)
 
-    return SPrimitiveProc(template)
+    return SPrimitiveProc(template, pure=True)
 
 
 def _gen_pair_set(part):
@@ -121,11 +160,436 @@ def _gen_isinstance(t):
         check_len_eq(operands, 1)
         return theTrue if isinstance(operands[0], t) else theFalse
 
-    return SPrimitiveProc(template)
+    return SPrimitiveProc(template, pure=True)
 
 
 def _prim_list(operands, *__):
-    return SPair(operands[0], _prim_list(operands[1:])) if operands else theNil
+    return SPair.make_list(operands)
+
+
+# list procedures, which loop instead of recursion
+
+def elements(lst):
+    """Return the elements of a proper list as a Python list."""
+    if lst.__class__ != SPair and lst is not theNil:
+        raise SchemeError('Not a proper list')
+    return lst.to_py_list()
+
+
+def _check_index(operands):
+    check_len_eq(operands, 2)
+    lst, k = operands
+    if k.__class__ != SInteger or k < 0:
+        raise SchemeError('Expected a non-negative integer')
+    return lst, k
+
+
+def _prim_length(operands, *__):
+    check_len_eq(operands, 1)
+    return SNumber(len(elements(operands[0])))
+
+
+def _prim_append(operands, *__):
+    if not operands:
+        return theNil
+    result = operands[-1]
+    for lst in reversed(operands[:-1]):
+        result = SPair.make_list(elements(lst), result)
+    return result
+
+
+def _prim_reverse(operands, *__):
+    check_len_eq(operands, 1)
+    lst, result = operands[0], theNil
+    while lst.__class__ == SPair:
+        result = SPair(lst.car, result)
+        lst = lst.cdr
+    if lst is not theNil:
+        raise SchemeError('Not a proper list')
+    return result
+
+
+def _prim_list_tail(operands, *__):
+    lst, k = _check_index(operands)
+    for __ in range(k):
+        if lst.__class__ != SPair:
+            raise SchemeError('Index out of range')
+        lst = lst.cdr
+    return lst
+
+
+def _prim_list_ref(operands, *__):
+    lst = _prim_list_tail(operands)
+    if lst.__class__ != SPair:
+        raise SchemeError('Index out of range')
+    return lst.car
+
+
+def _prim_last_pair(operands, *__):
+    lst = extract_instance(operands, SPair)
+    while lst.cdr.__class__ == SPair:
+        lst = lst.cdr
+    return lst
+
+
+def _gen_member(same):
+    """Used to generate member, memq and memv."""
+    def template(operands, *__):
+        check_len_eq(operands, 2)
+        x, lst = operands
+        while lst.__class__ == SPair:
+            if same(x, lst.car):
+                return lst
+            lst = lst.cdr
+        return theFalse
+
+    return SPrimitiveProc(template, pure=True)
+
+
+def _gen_assoc(same):
+    """Used to generate assoc, assq and assv."""
+    def template(operands, *__):
+        check_len_eq(operands, 2)
+        key, lst = operands
+        while lst.__class__ == SPair:
+            if lst.car.__class__ != SPair:
+                raise SchemeError('Expected a list of pairs')
+            if same(key, lst.car.car):
+                return lst.car
+            lst = lst.cdr
+        return theFalse
+
+    return SPrimitiveProc(template, pure=True)
+
+
+def _gen_cxr(name):
+    """Used to generate shortcuts like cadr, name is the a/d between c and
+    r, which are applied from right to left."""
+    parts = tuple('car' if i == 'a' else 'cdr' for i in reversed(name))
+
+    def template(operands, *__):
+        pair = extract_instance(operands, SPair)
+        for part in parts:
+            if pair.__class__ != SPair:
+                raise SchemeError('Expected a Pair')
+            pair = getattr(pair, part)
+        return pair
+
+    return 'c%sr' % name, SPrimitiveProc(template, pure=True)
+
+
+# higher-order list procedures. They call pure primitives themselves, and
+# let the evaluator call others, which passes the result back (see
+# TailCall.then). The state of the loop is never modified, as a
+# continuation captured in a call may be resumed more than once
+
+def _iterate(proc, items, operands, step, state, finish, env, i=0):
+    """Apply proc to operands(state, item) for each of items, and get the
+    next state by step(state, item, result). Return finish(state), or a
+    TailCall to go on by the evaluator."""
+    while i < len(items):
+        item = items[i]
+        if proc.__class__ != SPrimitiveProc or not proc.pure:
+            def then(values, *__, i=i, item=item, state=state):
+                return _iterate(proc, items, operands, step, step(state, item, values[0]),
+                                finish, env, i + 1)
+
+            return TailCall(proc, operands(state, item), SPrimitiveProc(then, 'callback'))
+        state = step(state, item, proc.apply(operands(state, item), env, None))
+        i += 1
+    return finish(state)
+
+
+def _check_proc(operands, num):
+    """Check a procedure followed by at least num lists, return the
+    procedure and the elements of the lists."""
+    check_len_gt(operands, num)
+    proc, *lists = operands
+    if not isinstance(proc, SProc):
+        raise SchemeError('Expected a procedure')
+    return proc, [elements(i) for i in lists]
+
+
+def _prim_map(operands, env, __):
+    proc, lists = _check_proc(operands, 1)
+    return _iterate(proc, tuple(zip(*lists)), lambda s, item: list(item),
+                    lambda s, item, value: SPair(value, s), theNil,
+                    lambda s: _prim_reverse([s]), env)
+
+
+def _prim_for_each(operands, env, __):
+    proc, lists = _check_proc(operands, 1)
+    return _iterate(proc, tuple(zip(*lists)), lambda s, item: list(item),
+                    lambda s, item, value: s, theNil, lambda s: s, env)
+
+
+def _prim_filter(operands, env, __):
+    check_len_eq(operands, 2)
+    proc, (lst,) = _check_proc(operands, 1)
+    return _iterate(proc, lst, lambda s, item: [item],
+                    lambda s, item, value: s if value is theFalse else SPair(item, s),
+                    theNil, lambda s: _prim_reverse([s]), env)
+
+
+def _prim_fold_left(operands, env, __):
+    check_len_eq(operands, 3)
+    proc, initial, lst = operands
+    proc, (lst,) = _check_proc((proc, lst), 1)
+    return _iterate(proc, lst, lambda s, item: [s, item], lambda s, item, value: value,
+                    initial, lambda s: s, env)
+
+
+def _prim_fold_right(operands, env, __):
+    check_len_eq(operands, 3)
+    proc, initial, lst = operands
+    proc, (lst,) = _check_proc((proc, lst), 1)
+    return _iterate(proc, lst[::-1], lambda s, item: [item, s], lambda s, item, value: value,
+                    initial, lambda s: s, env)
+
+
+# vectors
+
+def _check_vector(operands, low, high, t=SVector):
+    """Check the number of operands, the first of which is a vector of
+    type t, return the vector."""
+    check_len_in(operands, low, high)
+    if operands[0].__class__ != t:
+        raise SchemeError('Expected a %s' % t.__name__[1:])
+    return operands[0]
+
+
+def _check_size(k):
+    if k.__class__ != SInteger or k < 0:
+        raise SchemeError('Expected a non-negative integer')
+    return k
+
+
+def _check_ref(vector, k):
+    """Check index k of vector."""
+    if k.__class__ != SInteger or not 0 <= k < len(vector.items):
+        raise SchemeError('Index out of range')
+    return k
+
+
+def _prim_make_vector(operands, *__):
+    check_len_in(operands, 1, 2)
+    fill = operands[1] if len(operands) == 2 else SInteger(0)
+    return SVector([fill] * _check_size(operands[0]))
+
+
+def _prim_vector_length(operands, *__):
+    return SInteger(len(_check_vector(operands, 1, 1).items))
+
+
+def _prim_vector_ref(operands, *__):
+    vector = _check_vector(operands, 2, 2)
+    return vector.items[_check_ref(vector, operands[1])]
+
+
+def _prim_vector_set(operands, *__):
+    vector = _check_vector(operands, 3, 3)
+    vector.items[_check_ref(vector, operands[1])] = operands[2]
+    return theNil
+
+
+def _prim_vector_fill(operands, *__):
+    vector = _check_vector(operands, 2, 2)
+    vector.items[:] = [operands[1]] * len(vector.items)
+    return theNil
+
+
+def _prim_vector_to_list(operands, *__):
+    return SPair.make_list(_check_vector(operands, 1, 1).items)
+
+
+def _prim_list_to_vector(operands, *__):
+    check_len_eq(operands, 1)
+    return SVector(elements(operands[0]))
+
+
+# arithmetic primitives that numeric vector map applies to whole arrays
+_array_ops = {_prim_add: operator.add, _prim_sub: operator.sub,
+              _prim_mul: operator.mul, _prim_div: operator.truediv}
+
+
+def _gen_num_vector(t):
+    """Used to generate primitives of numeric vectors of type t, like
+    f64vector-ref."""
+    number, total = t.number, math.fsum if t.typecode == 'd' else sum
+
+    def make(operands, *__):
+        check_len_in(operands, 1, 2)
+        fill = operands[1] if len(operands) == 2 else 0
+        return t([fill] * _check_size(operands[0]))
+
+    def ref(operands, *__):
+        vector = _check_vector(operands, 2, 2, t)
+        return number(vector.items[_check_ref(vector, operands[1])])
+
+    def set_(operands, *__):
+        vector = _check_vector(operands, 3, 3, t)
+        vector.items[_check_ref(vector, operands[1])] = operands[2]
+        return theNil
+
+    def length(operands, *__):
+        return SInteger(len(_check_vector(operands, 1, 1, t).items))
+
+    def to_list(operands, *__):
+        return SPair.make_list([number(i) for i in _check_vector(operands, 1, 1, t).items])
+
+    def from_list(operands, *__):
+        check_len_eq(operands, 1)
+        return t(elements(operands[0]))
+
+    def map_(operands, env, __):
+        check_len_gt(operands, 1)
+        proc, *vectors = operands
+        for i in vectors:
+            _check_vector((i,), 1, 1, t)
+        op = _array_ops.get(getattr(proc, '_imp', None))
+        if op is not None and len(vectors) == 2:
+            return t(map(op, vectors[0].items, vectors[1].items))
+        if not isinstance(proc, SProc):
+            raise SchemeError('Expected a procedure')
+        return _iterate(proc, tuple(zip(*(i.items for i in vectors))),
+                        lambda s, item: [number(i) for i in item],
+                        lambda s, item, value: SPair(value, s), theNil,
+                        lambda s: t(reversed(s.to_py_list())), env)
+
+    def sum_(operands, *__):
+        return number(total(_check_vector(operands, 1, 1, t).items))
+
+    def dot(operands, *__):
+        check_len_eq(operands, 2)
+        x, y = (_check_vector((i,), 1, 1, t).items for i in operands)
+        if len(x) != len(y):
+            raise SchemeError('Vectors of different lengths')
+        return number(total(map(operator.mul, x, y)))
+
+    name = t.tag + 'vector'
+    return (
+        ('make-' + name, SPrimitiveProc(make, pure=True)),
+        (name, SPrimitiveProc(lambda operands, *__: t(operands), pure=True)),
+        (name + '?', _gen_isinstance(t)),
+        (name + '-length', SPrimitiveProc(length, pure=True)),
+        (name + '-ref', SPrimitiveProc(ref, pure=True)),
+        (name + '-set!', SPrimitiveProc(set_)),
+        (name + '->list', SPrimitiveProc(to_list, pure=True)),
+        ('list->' + name, SPrimitiveProc(from_list, pure=True)),
+        (name + '-map', SPrimitiveProc(map_)),
+        (name + '-sum', SPrimitiveProc(sum_, pure=True)),
+        (name + '-dot', SPrimitiveProc(dot, pure=True)),
+    )
+
+
+# hash tables
+
+def _check_table(operands, low, high):
+    """Check the number of operands, the first of which is a hash table,
+    return the table."""
+    check_len_in(operands, low, high)
+    if operands[0].__class__ != SHashTable:
+        raise SchemeError('Expected a hash table')
+    return operands[0]
+
+
+def _prim_make_hash_table(operands, *__):
+    check_len_in(operands, 0, 1)
+    if not operands:
+        return SHashTable(True)
+    if operands[0].__class__ == SPrimitiveProc and operands[0].name in ('eq?', 'eqv?', 'equal?'):
+        return SHashTable(operands[0].name == 'equal?')
+    raise SchemeError('Expected eq?, eqv? or equal?')
+
+
+def _prim_hash_table_ref(operands, *__):
+    table = _check_table(operands, 2, 3)
+    entry = table.entries.get(table.key(operands[1]))
+    if entry is not None:
+        return entry[1]
+    if len(operands) == 3:
+        return TailCall(operands[2], [])  # the failure thunk
+    raise SchemeError('No such key (%s)' % operands[1])
+
+
+def _prim_hash_table_ref_default(operands, *__):
+    table = _check_table(operands, 3, 3)
+    entry = table.entries.get(table.key(operands[1]))
+    return operands[2] if entry is None else entry[1]
+
+
+def _prim_hash_table_set(operands, *__):
+    table = _check_table(operands, 3, 3)
+    table.entries[table.key(operands[1])] = (operands[1], operands[2])
+    return theNil
+
+
+def _prim_hash_table_delete(operands, *__):
+    table = _check_table(operands, 2, 2)
+    table.entries.pop(table.key(operands[1]), None)
+    return theNil
+
+
+def _prim_hash_table_contains(operands, *__):
+    table = _check_table(operands, 2, 2)
+    return theTrue if table.key(operands[1]) in table.entries else theFalse
+
+
+def _update(table, key, proc, value):
+    """Return a TailCall that sets key to the result of proc applied to
+    value (a TailCall to get it, or the value itself)."""
+    k = table.key(key)
+
+    def store(values, *__):
+        table.entries[k] = (key, values[0])
+        return theNil
+
+    store = SPrimitiveProc(store, 'hash-table-update!')
+    if value.__class__ == TailCall:
+        return TailCall(value.proc, value.operands, SPrimitiveProc(
+            lambda values, *__: TailCall(proc, values, store), 'hash-table-update!'))
+    return TailCall(proc, [value], store)
+
+
+def _prim_hash_table_update(operands, *__):
+    table = _check_table(operands, 3, 4)
+    entry = table.entries.get(table.key(operands[1]))
+    if entry is not None:
+        return _update(table, operands[1], operands[2], entry[1])
+    if len(operands) == 4:
+        return _update(table, operands[1], operands[2], TailCall(operands[3], []))
+    raise SchemeError('No such key (%s)' % operands[1])
+
+
+def _prim_hash_table_update_default(operands, *__):
+    table = _check_table(operands, 4, 4)
+    entry = table.entries.get(table.key(operands[1]))
+    return _update(table, operands[1], operands[2],
+                   operands[3] if entry is None else entry[1])
+
+
+def _prim_hash_table_count(operands, *__):
+    return SNumber(len(_check_table(operands, 1, 1).entries))
+
+
+def _prim_hash_table_keys(operands, *__):
+    table = _check_table(operands, 1, 1)
+    return SPair.make_list([k for k, __ in table.entries.values()])
+
+
+def _prim_hash_table_values(operands, *__):
+    table = _check_table(operands, 1, 1)
+    return SPair.make_list([v for __, v in table.entries.values()])
+
+
+def _prim_hash_table_walk(operands, env, __):
+    table = _check_table(operands, 2, 2)
+    proc = operands[1]
+    if not isinstance(proc, SProc):
+        raise SchemeError('Expected a procedure')
+    # walk a copy, proc may change the table
+    return _iterate(proc, tuple(table.entries.values()), lambda s, entry: list(entry),
+                    lambda s, entry, value: s, theNil, lambda s: s, env)
 
 
 def _prim_apply(operands, env, evaluator):
@@ -140,11 +604,46 @@ def _prim_apply(operands, env, evaluator):
     return proc.apply(args, env, evaluator)
 
 
-def _prim_read(operands, *__):
-    check_len_eq(operands, 0)
-    make_symbols = lambda exp: (analyze(exp) if exp.__class__ == str
-                                else SPair.make_list([make_symbols(i) for i in exp]))
-    return make_symbols(parse_input())
+def _input_port(operands, evaluator):
+    """The port given as the optional operand, or the current input port
+    of evaluator."""
+    check_len_in(operands, 0, 1)
+    if not operands:
+        evaluator.output.flush()  # show the prompt, if any
+        return evaluator.input
+    if not isinstance(operands[0], SInputPort):
+        raise SchemeError('Expected a InputPort')
+    return operands[0]
+
+
+def _prim_read(operands, __, evaluator):
+    exp = _input_port(operands, evaluator).read()
+    return theEof if exp is None else SExpQuote.walker(exp)
+
+
+def _prim_open_input_string(operands, *__):
+    return SInputPort(lambda: '', text=str(extract_instance(operands, SString)))
+
+
+def _prim_call_with_input_file(operands, *__):
+    check_len_eq(operands, 2)
+    path, proc = operands
+    if not isinstance(path, SString):
+        raise SchemeError('Expected a String')
+    port = SInputPort.from_file(path)
+
+    def then(operands, *__):
+        port.close()
+        return operands[0]
+    return TailCall(proc, [port], SPrimitiveProc(then, 'callback'))
+
+
+def _prim_close_port(operands, *__):
+    check_len_eq(operands, 1)
+    if not isinstance(operands[0], (SInputPort, SOutputPort)):
+        raise SchemeError('Expected a port')
+    operands[0].close()
+    return theNil
 
 
 def _prim_error(operands, *__):
@@ -155,8 +654,19 @@ def _prim_load(operands, env, evaluator):
     path = extract_instance(operands, SString)
     if not path.endswith('.scm'):
         path += '.scm'
-    with open(path, encoding='utf-8') as f:
-        return EvalRequest(map(analyze, parse(f.read())), env, as_value=True)
+    expressions = cache.expressions(path, evaluator.cache)
+
+    def then(operands, *__):
+        """Evaluate the next expression, given the value of the last one."""
+        exp = next(expressions, None)
+        if exp is None:
+            return operands[0]
+        # loaded code is evaluated in top level, even if load is called by a
+        # procedure, whose frame can't have new variables
+        code = evaluator.compile(exp)
+        return TailCall(SCompoundProc((), code, env.top), [], callback)
+    callback = SPrimitiveProc(then, 'load')
+    return then([theNil])
 
 
 def _prim_load_ext(operands, env, __):
@@ -165,34 +675,81 @@ def _prim_load_ext(operands, env, __):
     ext = __import__(str(module_name))
     if not hasattr(ext, 'tsi_ext_flag'):
         raise SchemeError('Wrong extension name')
-    ext.setup(env)
+    ext.setup(env.top)
     return theNil
 
 
 prim_proc_name_imp = (
     # arithmetic
-    ('+', SPrimitiveProc(_prim_add)),
-    ('-', SPrimitiveProc(_prim_sub)),
-    ('*', SPrimitiveProc(_prim_mul)),
-    ('/', SPrimitiveProc(_prim_div)),
-    ('min', SPrimitiveProc(_prim_min)),
-    ('max', SPrimitiveProc(_prim_max)),
-    ('modulo', SPrimitiveProc(_prim_modulo)),
+    ('+', SPrimitiveProc(_prim_add, pure=True)),
+    ('-', SPrimitiveProc(_prim_sub, pure=True)),
+    ('*', SPrimitiveProc(_prim_mul, pure=True)),
+    ('/', SPrimitiveProc(_prim_div, pure=True)),
+    ('min', SPrimitiveProc(_prim_min, pure=True)),
+    ('max', SPrimitiveProc(_prim_max, pure=True)),
+    ('modulo', SPrimitiveProc(_prim_modulo, pure=True)),
     ('<', _gen_prim_cmp(lambda x, y: x < y)),
     ('<=', _gen_prim_cmp(lambda x, y: x <= y)),
     ('=', _gen_prim_cmp(lambda x, y: x == y)),
     ('>', _gen_prim_cmp(lambda x, y: x > y)),
     ('>=', _gen_prim_cmp(lambda x, y: x >= y)),
 
-    ('eq?', SPrimitiveProc(_prim_eq)),
-    ('not', SPrimitiveProc(_prim_not)),
+    ('eq?', _gen_prim_same(is_eq)),
+    ('eqv?', _gen_prim_same(is_eqv)),
+    ('equal?', _gen_prim_same(is_equal)),
+    ('not', SPrimitiveProc(_prim_not, pure=True)),
     # pair & list
-    ('cons', SPrimitiveProc(_prim_cons)),
+    ('cons', SPrimitiveProc(_prim_cons, pure=True)),
     ('car', _gen_pair_dr('car')),
     ('cdr', _gen_pair_dr('cdr')),
-    ('list', SPrimitiveProc(_prim_list)),
+    ('list', SPrimitiveProc(_prim_list, pure=True)),
     ('set-car!', _gen_pair_set('car')),
     ('set-cdr!', _gen_pair_set('cdr')),
+    ('length', SPrimitiveProc(_prim_length, pure=True)),
+    ('append', SPrimitiveProc(_prim_append, pure=True)),
+    ('reverse', SPrimitiveProc(_prim_reverse, pure=True)),
+    ('list-tail', SPrimitiveProc(_prim_list_tail, pure=True)),
+    ('list-ref', SPrimitiveProc(_prim_list_ref, pure=True)),
+    ('last-pair', SPrimitiveProc(_prim_last_pair, pure=True)),
+    ('memq', _gen_member(is_eq)),
+    ('memv', _gen_member(is_eqv)),
+    ('member', _gen_member(is_equal)),
+    ('assq', _gen_assoc(is_eq)),
+    ('assv', _gen_assoc(is_eqv)),
+    ('assoc', _gen_assoc(is_equal)),
+    ('map', SPrimitiveProc(_prim_map)),
+    ('for-each', SPrimitiveProc(_prim_for_each)),
+    ('filter', SPrimitiveProc(_prim_filter)),
+    ('fold-left', SPrimitiveProc(_prim_fold_left)),
+    ('fold-right', SPrimitiveProc(_prim_fold_right)),
+    ('accumulate', SPrimitiveProc(_prim_fold_right)),
+    *(_gen_cxr(''.join(i)) for n in (2, 3, 4) for i in product('ad', repeat=n)),
+    # vector
+    ('make-vector', SPrimitiveProc(_prim_make_vector, pure=True)),
+    ('vector', SPrimitiveProc(lambda operands, *__: SVector(list(operands)), pure=True)),
+    ('vector?', _gen_isinstance(SVector)),
+    ('vector-length', SPrimitiveProc(_prim_vector_length, pure=True)),
+    ('vector-ref', SPrimitiveProc(_prim_vector_ref, pure=True)),
+    ('vector-set!', SPrimitiveProc(_prim_vector_set)),
+    ('vector-fill!', SPrimitiveProc(_prim_vector_fill)),
+    ('vector->list', SPrimitiveProc(_prim_vector_to_list, pure=True)),
+    ('list->vector', SPrimitiveProc(_prim_list_to_vector, pure=True)),
+    *_gen_num_vector(SF64Vector),
+    *_gen_num_vector(SS64Vector),
+    # hash table
+    ('make-hash-table', SPrimitiveProc(_prim_make_hash_table)),
+    ('hash-table?', _gen_isinstance(SHashTable)),
+    ('hash-table-ref', SPrimitiveProc(_prim_hash_table_ref)),
+    ('hash-table-ref/default', SPrimitiveProc(_prim_hash_table_ref_default, pure=True)),
+    ('hash-table-set!', SPrimitiveProc(_prim_hash_table_set)),
+    ('hash-table-delete!', SPrimitiveProc(_prim_hash_table_delete)),
+    ('hash-table-contains?', SPrimitiveProc(_prim_hash_table_contains, pure=True)),
+    ('hash-table-update!', SPrimitiveProc(_prim_hash_table_update)),
+    ('hash-table-update!/default', SPrimitiveProc(_prim_hash_table_update_default)),
+    ('hash-table-count', SPrimitiveProc(_prim_hash_table_count, pure=True)),
+    ('hash-table-keys', SPrimitiveProc(_prim_hash_table_keys, pure=True)),
+    ('hash-table-values', SPrimitiveProc(_prim_hash_table_values, pure=True)),
+    ('hash-table-walk', SPrimitiveProc(_prim_hash_table_walk)),
     # isinstance
     ('null?', _gen_isinstance(SNil)),
     ('boolean?', _gen_isinstance(SBool)),
@@ -204,14 +761,44 @@ prim_proc_name_imp = (
     ('real?', _gen_isinstance(SReal)),
     # system
     ('apply', SPrimitiveProc(_prim_apply)),
-    ('read', SPrimitiveProc(_prim_read)),
     ('load', SPrimitiveProc(_prim_load)),
     ('load-ext', SPrimitiveProc(_prim_load_ext)),
     ('error', SPrimitiveProc(_prim_error, err_msg_name=False)),
     ('exit', SPrimitiveProc(lambda *__: sys.exit(0))),
+    # output
     ('display', SPrimitiveProc(_prim_display)),
-    ('print', SPrimitiveProc(lambda operands, *__: print(*operands) or theNil)),
-    ('newline', SPrimitiveProc(lambda *__: print() or theNil)),
+    ('print', SPrimitiveProc(_prim_print)),
+    ('newline', SPrimitiveProc(_prim_newline)),
+    ('flush-output', SPrimitiveProc(_prim_flush_output)),
+    ('current-output-port', SPrimitiveProc(lambda operands, __, evaluator: (
+        check_len_eq(operands, 0) or evaluator.output))),
+    ('open-output-string', SPrimitiveProc(lambda operands, *__: (
+        check_len_eq(operands, 0) or SStringOutputPort()))),
+    ('get-output-string', SPrimitiveProc(_prim_get_output_string)),
+    ('output-port?', _gen_isinstance(SOutputPort)),
+    ('close-output-port', SPrimitiveProc(lambda operands, *__: (
+        extract_instance(operands, SOutputPort).close() or theNil))),
+    # input
+    ('read', SPrimitiveProc(_prim_read)),
+    ('read-char', SPrimitiveProc(lambda operands, __, evaluator: (
+        _input_port(operands, evaluator).read_char()))),
+    ('peek-char', SPrimitiveProc(lambda operands, __, evaluator: (
+        _input_port(operands, evaluator).peek_char()))),
+    ('read-line', SPrimitiveProc(lambda operands, __, evaluator: (
+        _input_port(operands, evaluator).read_line()))),
+    ('open-input-file', SPrimitiveProc(lambda operands, *__: (
+        SInputPort.from_file(extract_instance(operands, SString))))),
+    ('open-input-string', SPrimitiveProc(_prim_open_input_string)),
+    ('call-with-input-file', SPrimitiveProc(_prim_call_with_input_file)),
+    ('close-input-port', SPrimitiveProc(lambda operands, *__: (
+        extract_instance(operands, SInputPort).close() or theNil))),
+    ('close-port', SPrimitiveProc(_prim_close_port)),
+    ('current-input-port', SPrimitiveProc(lambda operands, __, evaluator: (
+        check_len_eq(operands, 0) or evaluator.input))),
+    ('input-port?', _gen_isinstance(SInputPort)),
+    ('eof-object', SPrimitiveProc(lambda operands, *__: (
+        check_len_eq(operands, 0) or theEof), pure=True)),
+    ('eof-object?', _gen_isinstance(SEofObject)),
 )
 
 # register names